@@ -5,10 +5,30 @@ Run: python3 app.py
 Then open: http://localhost:7878
 """
 
+import argparse
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import ctypes
+import email.utils
+import hashlib
+import http.client
 import http.server
+import io
 import socketserver
 import json
+import mmap
+import multiprocessing
 import os
+import re
+import resource
+import shutil
+import signal
+import socket
+import sqlite3
 import subprocess
 import sys
 import time
@@ -19,14 +39,101 @@ from pathlib import Path
 
 PORT = int(os.environ.get("PORT", 7878))
 MAX_UPLOAD_BYTES = 150 * 1024 * 1024  # 150 MB
+UPLOAD_CHUNK_BYTES = 64 * 1024        # socket read size while streaming uploads
+MAX_FIELD_BYTES = 64 * 1024           # cap for non-file form fields
+MAX_PART_HEADER_BYTES = 16 * 1024
 MAX_JOBS = 500
+MAX_BATCH_VARIANTS = 8  # outputs per batch /convert (one decode)
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", os.cpu_count() or 2))
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", 50))
+# Work limits checked against the input probe before a job is queued
+MAX_CLIP_SECONDS = int(os.environ.get("MAX_CLIP_SECONDS", 300))
+MAX_OUTPUT_FRAMES = int(os.environ.get("MAX_OUTPUT_FRAMES", 3000))
+MAX_OUTPUT_WIDTH = int(os.environ.get("MAX_OUTPUT_WIDTH", 1920))  # wider requests are scaled down
+MAX_OUTPUT_PIXELS = int(os.environ.get("MAX_OUTPUT_PIXELS", 1920 * 1920))  # per frame; scaled down too
+MAX_OUTPUT_BYTES = int(os.environ.get("MAX_OUTPUT_BYTES", 200 * 1024 * 1024))
+# Per ffmpeg child: decoder/filter/encoder threads (0: ffmpeg's default) and
+# address space (RLIMIT_AS; 0: unlimited)
+FFMPEG_THREADS = int(os.environ.get("FFMPEG_THREADS", 0))
+FFMPEG_MEMORY_LIMIT_BYTES = int(os.environ.get("FFMPEG_MEMORY_LIMIT_BYTES", 4 * 1024 ** 3))
+PROBE_CACHE_SIZE = 256  # input probes kept, by upload SHA-256
+RETRY_AFTER_SECONDS = 30
+SSE_KEEPALIVE_SECONDS = 15
+# Async front end (--server async) timeouts, in seconds
+ASYNC_HEADER_TIMEOUT = 10      # to receive a complete request head
+ASYNC_KEEPALIVE_TIMEOUT = 15   # idle time before the next keep-alive request
+ASYNC_BODY_READ_TIMEOUT = 30   # max silence while an upload body is streaming
+ASYNC_UPLOAD_TIMEOUT = 600     # total time allowed for one upload body
+FFMPEG_STALL_SECONDS = int(os.environ.get("FFMPEG_STALL_SECONDS", 60))  # no -progress output → kill
+# Stream-copy the requested start/end window to a small temp file first
+PRETRIM_ENABLED = os.environ.get("PRETRIM", "1") != "0"
+# dedupe mode (libvips): mean per-channel difference on a 64 px thumbnail below
+# which a frame counts as a duplicate of the last kept one
+DEDUPE_THRESHOLD = 1.0
+# max_bytes mode: seconds of clip sample-encoded to estimate each candidate's size
+FIT_SAMPLE_SECONDS = 2.0
+FIT_MAX_FULL_ENCODES = 3
+# libvips frames are held in RAM up to this size, then spilled to one raw file
+LIBVIPS_SPOOL_MEMORY_BYTES = int(os.environ.get("LIBVIPS_SPOOL_MEMORY_BYTES", 256 * 1024 * 1024))
+# ffmpeg-high palette strategy: "two-pass" (palette file, then render),
+# "single-pass" (split → palettegen → paletteuse in one filtergraph) or
+# "sampled" (palette from PALETTE_SAMPLES keyframe seeks, then render)
+PALETTE_MODE = os.environ.get("PALETTE_MODE", "two-pass")
+PALETTE_MODES = ("two-pass", "single-pass", "sampled")
+PALETTE_SAMPLES = int(os.environ.get("PALETTE_SAMPLES", 24))
+PALETTEUSE = "paletteuse=dither=bayer:bayer_scale=5:diff_mode=rectangle"
+# ffmpeg-high: render this many time segments in parallel against the shared
+# palette and join them; segments are never shorter than SEGMENT_MIN_SECONDS
+SEGMENTS = int(os.environ.get("SEGMENTS", 1))
+SEGMENT_MIN_SECONDS = 4.0
+ENCODERS = ("ffmpeg-high", "libvips", "ffmpeg-med")
+# Output formats and their file suffixes. Every format is fed the same trimmed,
+# scaled frame stream; libvips writes gif and webp, ffmpeg writes all four
+FORMATS = {"gif": ".gif", "webp": ".webp", "apng": ".apng", "mp4": ".mp4"}
+WEBP_QUALITY = int(os.environ.get("WEBP_QUALITY", 75))
+MP4_CRF = int(os.environ.get("MP4_CRF", 23))
+# By-products of the main decode (previews=0 turns them off): a JPEG poster,
+# the most representative of the first POSTER_SCAN_FRAMES output frames, and
+# a small low-fps preview GIF
+PREVIEWS_ENABLED = os.environ.get("PREVIEWS", "1") != "0"
+POSTER_SCAN_FRAMES = 30
+PREVIEW_FPS = 5
+PREVIEW_WIDTH = 240
+# Files /output/ serves, by suffix
+OUTPUT_TYPES = {".gif": "image/gif", ".webp": "image/webp", ".apng": "image/apng",
+                ".mp4": "video/mp4", ".jpg": "image/jpeg"}
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 500 * 1024 * 1024))
+# Finished outputs are capped at OUTPUT_QUOTA_BYTES (least recently accessed
+# jobs are evicted as new ones finish) and expire after OUTPUT_MAX_AGE_SECONDS
+# unaccessed. Uploads are refused while the output or spool disk would drop
+# below MIN_FREE_DISK_BYTES free, even after evicting outputs (off by
+# default: a fixed reserve would refuse every upload on a small disk).
+# 0 disables each.
+OUTPUT_QUOTA_BYTES = int(os.environ.get("OUTPUT_QUOTA_BYTES", 2 * 1024 ** 3))
+OUTPUT_MAX_AGE_SECONDS = int(os.environ.get("OUTPUT_MAX_AGE_SECONDS", 3600))
+MIN_FREE_DISK_BYTES = int(os.environ.get("MIN_FREE_DISK_BYTES", 0))
 BASE_DIR = Path(__file__).parent
 OUTPUT_DIR = BASE_DIR / "output"
 OUTPUT_DIR.mkdir(exist_ok=True)
-
-# Track job progress
-jobs = {}
-jobs_lock = threading.Lock()
+SPOOL_DIR = Path(os.environ.get("SPOOL_DIR", BASE_DIR / "spool"))  # uploads awaiting conversion
+SPOOL_DIR.mkdir(exist_ok=True)
+
+# Job records + FIFO: "sqlite" (shared by every process on the host, survives
+# restarts) or "memory" (this process only)
+JOB_STORE = os.environ.get("JOB_STORE", "sqlite")
+JOB_DB_PATH = Path(os.environ.get("JOB_DB_PATH", BASE_DIR / "jobs.db"))
+JOB_STORE_POLL_SECONDS = 1.0   # re-check interval for changes made by other processes
+JOB_HEARTBEAT_SECONDS = 5      # running jobs are touched this often by their owner…
+JOB_STALE_SECONDS = 60         # …and requeued once their heartbeat is this old
+JOB_MAX_ATTEMPTS = 3           # a job whose worker dies this often fails instead
+PROCESS_TOKEN = uuid.uuid4().hex[:8]
+
+# Extra callables run with a job id after set_job(), or with None after a
+# claim moves the queue (async front end; see notify_job)
+job_listeners = []
+
+# Wakes idle workers when a job is queued
+job_queue_cond = threading.Condition()
 
 HTML = """<!DOCTYPE html>
 <html lang="en">
@@ -331,7 +438,7 @@ HTML = """<!DOCTYPE html>
 
   .result-section.visible { display: block; animation: flash-success 0.6s ease; }
 
-  .result-section img {
+  .result-section img, .result-section video {
     max-width: 100%;
     max-height: 320px;
     border-radius: 6px;
@@ -457,6 +564,34 @@ HTML = """<!DOCTYPE html>
       </select>
     </div>
 
+    <div class="option-group">
+      <label>Format</label>
+      <select id="format">
+        <option value="gif" selected>GIF</option>
+        <option value="webp">WebP</option>
+        <option value="apng">APNG</option>
+        <option value="mp4">MP4</option>
+      </select>
+    </div>
+
+    <div class="option-group">
+      <label>Static frames</label>
+      <select id="dedupe">
+        <option value="" selected>Keep all</option>
+        <option value="1">Merge duplicates</option>
+      </select>
+    </div>
+
+    <div class="option-group">
+      <label>Max size</label>
+      <select id="maxBytes">
+        <option value="" selected>No limit</option>
+        <option value="8388608">8 MB</option>
+        <option value="26214400">25 MB</option>
+        <option value="52428800">50 MB</option>
+      </select>
+    </div>
+
     <div class="option-group">
       <label>Loop</label>
       <select id="loop">
@@ -480,6 +615,7 @@ HTML = """<!DOCTYPE html>
   <!-- Result -->
   <div class="result-section" id="resultSection">
     <img id="resultGif" src="" alt="Result GIF">
+    <video id="resultVideo" autoplay loop muted playsinline style="display:none"></video>
     <div class="result-meta" id="resultMeta"></div>
     <a class="download-btn" id="downloadBtn" href="#" download>Download GIF</a>
     <br>
@@ -506,6 +642,7 @@ const progressLabel = document.getElementById('progressLabel');
 const progressBar = document.getElementById('progressBar');
 const resultSection = document.getElementById('resultSection');
 const resultGif = document.getElementById('resultGif');
+const resultVideo = document.getElementById('resultVideo');
 const resultMeta = document.getElementById('resultMeta');
 const downloadBtn = document.getElementById('downloadBtn');
 const resetBtn = document.getElementById('resetBtn');
@@ -555,6 +692,7 @@ convertBtn.addEventListener('click', async () => {
   progressSection.classList.add('visible');
   progressLabel.textContent = 'Uploading video…';
   progressBar.classList.add('indeterminate');
+  progressBar.style.width = '';
   resultSection.classList.remove('visible');
 
   const formData = new FormData();
@@ -564,7 +702,10 @@ convertBtn.addEventListener('click', async () => {
   formData.append('start', document.getElementById('startTime').value || '');
   formData.append('end', document.getElementById('endTime').value || '');
   formData.append('encoder', document.getElementById('encoder').value);
+  formData.append('format', document.getElementById('format').value);
   formData.append('loop', document.getElementById('loop').value);
+  formData.append('max_bytes', document.getElementById('maxBytes').value);
+  formData.append('dedupe', document.getElementById('dedupe').value);
 
   try {
     const res = await fetch('/convert', { method: 'POST', body: formData });
@@ -572,35 +713,93 @@ convertBtn.addEventListener('click', async () => {
     if (data.error) throw new Error(data.error);
     jobId = data.job_id;
     progressLabel.textContent = 'Converting… (this may take a moment)';
-    pollJob();
+    watchJob();
   } catch(e) {
     showError(e.message);
   }
 });
 
+// Returns true once the job has finished (either way)
+function handleStatus(data) {
+  if (data.status === 'done') {
+    showResult(data);
+    return true;
+  } else if (data.status === 'error') {
+    showError(data.error);
+    return true;
+  }
+  if (data.step) {
+    const pct = data.progress != null ? ` ${Math.round(data.progress * 100)}%` : '';
+    const speed = data.speed ? ` · ${data.speed}× realtime` : '';
+    const eta = data.eta != null ? ` · ~${data.eta} s left` : '';
+    progressLabel.textContent = data.step + pct + speed + eta;
+  }
+  if (data.progress != null) {
+    progressBar.classList.remove('indeterminate');
+    progressBar.style.width = (data.progress * 100) + '%';
+  } else {
+    progressBar.classList.add('indeterminate');
+  }
+  return false;
+}
+
+// Server-Sent Events, falling back to polling /status if the stream fails
+function watchJob() {
+  if (!window.EventSource) return pollJob();
+  const events = new EventSource('/events/' + jobId);
+  let finished = false;
+  events.onmessage = e => {
+    const data = JSON.parse(e.data);
+    if (data.status === 'unknown') {
+      events.close();
+      finished = true;
+      showError('Job not found. Please try again.');
+    } else if (handleStatus(data)) {
+      events.close();
+      finished = true;
+    }
+  };
+  events.onerror = () => {
+    events.close();
+    if (!finished) pollJob();
+  };
+}
+
 function pollJob() {
   pollTimer = setInterval(async () => {
     const res = await fetch('/status/' + jobId);
     const data = await res.json();
-
-    if (data.status === 'done') {
-      clearInterval(pollTimer);
-      showResult(data);
-    } else if (data.status === 'error') {
-      clearInterval(pollTimer);
-      showError(data.error);
-    } else {
-      if (data.step) progressLabel.textContent = data.step;
-    }
+    if (handleStatus(data)) clearInterval(pollTimer);
   }, 800);
 }
 
 function showResult(data) {
   progressSection.classList.remove('visible');
   resultSection.classList.add('visible');
-  resultGif.src = data.url + '?t=' + Date.now();
+  const isVideo = data.format === 'mp4';
+  resultGif.style.display = isVideo ? 'none' : '';
+  resultVideo.style.display = isVideo ? '' : 'none';
+  if (isVideo) {
+    resultVideo.poster = data.poster_url || '';
+    resultVideo.src = data.url;
+  }
+  // Poster first, then the small preview GIF, then the full output once loaded
+  let fullLoaded = false;
+  if (!isVideo) resultGif.src = data.poster_url || data.url;
+  if (!isVideo && data.poster_url) {
+    if (data.preview_url) {
+      const preview = new Image();
+      preview.onload = () => { if (!fullLoaded) resultGif.src = data.preview_url; };
+      preview.src = data.preview_url;
+    }
+    const full = new Image();
+    full.onload = () => { fullLoaded = true; resultGif.src = data.url; };
+    full.src = data.url;
+  }
   const encoderLabel = {'ffmpeg-high':'ffmpeg (2-pass)','libvips':'libvips','ffmpeg-med':'ffmpeg'}[data.encoder] || data.encoder;
-  resultMeta.textContent = `${data.width}×${data.height} · ${data.size} · ${data.frames} frames · ${data.fps} fps · ${encoderLabel}`;
+  const formatLabel = (data.format || 'gif').toUpperCase();
+  resultMeta.textContent = `${formatLabel} · ${data.width}×${data.height} · ${data.size} · ${data.frames} frames · ${data.fps} fps · ${encoderLabel}`;
+  downloadBtn.textContent = `Download ${formatLabel}`;
   downloadBtn.href = data.url;
   downloadBtn.download = data.filename;
   convertBtn.disabled = false;
@@ -632,6 +831,8 @@ resetBtn.addEventListener('click', () => {
   convertBtn.textContent = 'Select a video first';
   resultSection.classList.remove('visible');
   progressSection.classList.remove('visible');
+  resultVideo.pause();
+  resultVideo.removeAttribute('src');
 });
 </script>
 </body>
@@ -639,6 +840,9 @@ resetBtn.addEventListener('click', () => {
 """
 
 
+FAVICON_SVG = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 32 32"><rect width="32" height="32" rx="6" fill="#0a0a0a"/><text x="16" y="26" font-family="\'Inter\', system-ui, -apple-system, sans-serif" font-size="30" font-weight="900" fill="#c8ff00" text-anchor="middle">G</text></svg>'
+
+
 class Handler(http.server.BaseHTTPRequestHandler):
 
     def log_message(self, format, *args):
@@ -651,25 +855,28 @@ class Handler(http.server.BaseHTTPRequestHandler):
             self._send(200, "text/html", HTML.encode())
 
         elif path == "/favicon.svg":
-            svg = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 32 32"><rect width="32" height="32" rx="6" fill="#0a0a0a"/><text x="16" y="26" font-family="\'Inter\', system-ui, -apple-system, sans-serif" font-size="30" font-weight="900" fill="#c8ff00" text-anchor="middle">G</text></svg>'
-            self._send(200, "image/svg+xml", svg.encode())
+            self._send(200, "image/svg+xml", FAVICON_SVG.encode())
+
+        elif path == "/stats":
+            self._json(200, server_stats())
+
+        elif path == "/metrics":
+            self._send(200, "text/plain; version=0.0.4; charset=utf-8", metrics_text().encode())
 
         elif path.startswith("/status/"):
             job_id = path.split("/")[-1]
-            job = jobs.get(job_id, {"status": "unknown"})
-            self._json(200, job)
+            self._json(200, job_status(job_id))
+
+        elif path.startswith("/events/"):
+            job_id = path.split("/")[-1]
+            self._stream_events(job_id)
 
         elif path.startswith("/output/"):
             fname = path.split("/")[-1]
             fpath = OUTPUT_DIR / fname
-            if fpath.exists() and fpath.suffix == ".gif":
-                data = fpath.read_bytes()
-                self.send_response(200)
-                self.send_header("Content-Type", "image/gif")
-                self.send_header("Content-Length", str(len(data)))
-                self.send_header("Content-Disposition", f'attachment; filename="{fname}"')
-                self.end_headers()
-                self.wfile.write(data)
+            if fpath.exists() and fpath.suffix in OUTPUT_TYPES:
+                output_store.touch(fname)
+                self._send_file(fpath, OUTPUT_TYPES[fpath.suffix])
             else:
                 self._send(404, "text/plain", b"Not found")
         else:
@@ -678,110 +885,2746 @@ class Handler(http.server.BaseHTTPRequestHandler):
     def do_POST(self):
         if self.path == "/convert":
             content_length = int(self.headers.get("Content-Length", 0))
-            if content_length > MAX_UPLOAD_BYTES:
-                self._json(413, {"error": f"File too large. Max upload is 150 MB."})
+            rejected = upload_precheck(content_length)
+            if rejected:
+                self._json(*rejected)
                 return
             content_type = self.headers.get("Content-Type", "")
-            body = self.rfile.read(content_length)
-
-            job_id = str(uuid.uuid4())[:8]
-            with jobs_lock:
-                if len(jobs) >= MAX_JOBS:
-                    oldest = list(jobs.keys())[:50]
-                    for k in oldest:
-                        jobs.pop(k, None)
-                jobs[job_id] = {"status": "queued", "step": "Queued…"}
 
-            # Parse multipart
+            # Parse multipart straight off the socket; file parts go to disk
+            started = time.monotonic()
             try:
-                params = parse_multipart(body, content_type)
+                params = parse_multipart(self.rfile, content_length, content_type)
             except Exception as e:
+                record_upload(content_length, started, ok=False)
                 self._json(400, {"error": f"Upload parse error: {e}"})
                 return
+            record_upload(content_length, started, ok=True)
 
-            self._json(200, {"job_id": job_id})
-
-            # Run conversion in background thread
-            t = threading.Thread(target=run_conversion, args=(job_id, params), daemon=True)
-            t.start()
+            self._json(*submit_upload(params))
 
         else:
             self._send(404, "text/plain", b"Not found")
 
-    def _send(self, code, ctype, body):
+    def _send(self, code, ctype, body, headers=None):
         self.send_response(code)
         self.send_header("Content-Type", ctype)
         self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
         self.end_headers()
         self.wfile.write(body)
 
-    def _json(self, code, data):
+    def _json(self, code, data, headers=None):
         body = json.dumps(data).encode()
-        self._send(code, "application/json", body)
+        self._send(code, "application/json", body, headers)
+
+    def _send_file(self, fpath, ctype):
+        """Serve an immutable output file with sendfile, Range and 304 support."""
+        try:
+            f = open(fpath, "rb")
+        except OSError:
+            self._send(404, "text/plain", b"Not found")
+            return
+        with f:
+            status, headers, offset, count = file_response(f, ctype, fpath.name, self.headers)
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            if count:
+                self.wfile.flush()
+                self.connection.sendfile(f, offset, count)
+
+    def _stream_events(self, job_id):
+        """Server-Sent Events: push the job record whenever it changes.
+
+        Blocks on the job's job_events entry between updates (with a
+        periodic keepalive comment) and closes once the job is done, failed
+        or unknown.
+        """
+        self.send_response(200)
+        for k, v in SSE_HEADERS.items():
+            self.send_header(k, v)
+        self.end_headers()
+        last = None
+        last_write = time.monotonic()
+        try:
+            with job_events.listen(job_id) as events:
+                while True:
+                    version = job_events.version(events)
+                    job = job_status(job_id)
+                    if job != last:
+                        self.wfile.write(sse_message(job))
+                        last, last_write = job, time.monotonic()
+                        if job.get("status") in ("done", "error", "unknown"):
+                            break
+                        continue
+                    if time.monotonic() - last_write >= SSE_KEEPALIVE_SECONDS:
+                        self.wfile.write(SSE_KEEPALIVE)
+                        last_write = time.monotonic()
+                    job_events.wait(events, version, sse_wait_seconds())
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+# ── Request helpers (shared by Handler and AsyncGifMakerServer) ───────────────
+
+SSE_HEADERS = {
+    "Content-Type": "text/event-stream",
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+
+SSE_KEEPALIVE = b": keepalive\n\n"
+
+
+def sse_message(job: dict) -> bytes:
+    return f"data: {json.dumps(job)}\n\n".encode()
+
+
+def sse_wait_seconds() -> float:
+    """How long an /events stream sleeps before re-reading its job.
+
+    Local updates wake it immediately; a shared store may also be written
+    by other processes, which can only be seen by re-checking.
+    """
+    return JOB_STORE_POLL_SECONDS if job_store.shared else SSE_KEEPALIVE_SECONDS
+
+
+def busy_response():
+    return (503, {"error": "Server is busy. Please try again shortly."},
+            {"Retry-After": str(RETRY_AFTER_SECONDS)})
 
 
-def parse_multipart(body: bytes, content_type: str) -> dict:
-    """Simple multipart/form-data parser."""
-    import email
-    from email import policy
+def upload_precheck(content_length: int):
+    """Reject an upload before reading its body. Returns a response or None."""
+    if content_length > MAX_UPLOAD_BYTES:
+        return 413, {"error": f"File too large. Max upload is 150 MB."}
+    if queue_full():
+        return busy_response()
+    if not disk_has_room(content_length):
+        return (503, {"error": "Server is low on disk space. Please try again later."},
+                {"Retry-After": str(RETRY_AFTER_SECONDS)})
+    return None
 
-    # Extract boundary
-    boundary = None
+
+def record_upload(nbytes: int, started: float, ok: bool):
+    """Upload body size and receive time; a parse failure counts as "failed"."""
+    metrics.observe("gifmaker_upload_bytes", nbytes)
+    metrics.observe("gifmaker_upload_seconds", time.monotonic() - started)
+    if not ok:
+        metrics.inc("gifmaker_uploads_total", result="failed")
+
+
+def submit_upload(params: dict):
+    """Turn a parsed /convert upload into a job. Returns (code, data[, headers])."""
+    try:
+        opts = conversion_options(params)
+        forms = batch_forms(params)
+    except ValueError as e:
+        _discard_uploads(params)
+        metrics.inc("gifmaker_uploads_total", result="invalid")
+        return 400, {"error": str(e)}
+
+    # Probe the input once, up front: bad or oversized uploads are refused
+    # here instead of after minutes in ffmpeg
+    video = params.get("video")
+    if isinstance(video, dict):
+        try:
+            video["media"] = probe_media(video["path"], video["sha256"])
+            if forms is not None:
+                forms = [{**form, **limit_work(video["media"], batch_options(form))}
+                         for form in forms]
+                params["variants"] = json.dumps(forms)
+            else:
+                overrides = limit_work(video["media"], opts)
+                if overrides:
+                    params.update(overrides)
+                    opts = conversion_options(params)
+        except ValueError as e:
+            _discard_uploads(params)
+            metrics.inc("gifmaker_uploads_total", result="invalid")
+            return 400, {"error": str(e)}
+        except (subprocess.SubprocessError, OSError) as e:
+            # ffprobe missing, timed out or failed to start: not the client's fault
+            _discard_uploads(params)
+            metrics.inc("gifmaker_uploads_total", result="failed")
+            return (503, {"error": f"Could not inspect the upload: {e}"},
+                    {"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+    job_id = str(uuid.uuid4())[:8]
+    job_store.trim(MAX_JOBS)
+
+    # Identical upload + options already rendered? Serve it directly.
+    if isinstance(video, dict) and forms is not None:
+        outputs = [result_cache.get(cache_key(video["sha256"], batch_options(form))) for form in forms]
+        if all(outputs):
+            for output in outputs:
+                output_store.touch(output["filename"])
+            set_job(job_id, {"status": "done", "outputs": outputs, "cached": True})
+            _discard_uploads(params)
+            metrics.inc("gifmaker_uploads_total", result="cached")
+            metrics.inc("gifmaker_jobs_total", encoder="batch", status="cached")
+            return 200, {"job_id": job_id}
+    elif isinstance(video, dict):
+        cached = result_cache.get(cache_key(video["sha256"], opts))
+        if cached:
+            output_store.touch(cached["filename"])
+            set_job(job_id, {**cached, "cached": True})
+            _discard_uploads(params)
+            metrics.inc("gifmaker_uploads_total", result="cached")
+            metrics.inc("gifmaker_jobs_total", encoder=opts["encoder"], status="cached")
+            return 200, {"job_id": job_id}
+
+    # Hand off to the worker pool
+    if not enqueue_job(job_id, params):
+        _discard_uploads(params)
+        metrics.inc("gifmaker_uploads_total", result="busy")
+        return busy_response()
+
+    metrics.inc("gifmaker_uploads_total", result="queued")
+    return 200, {"job_id": job_id}
+
+
+def _not_modified(request_headers, etag: str, mtime: float) -> bool:
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match:
+        return etag in [t.strip() for t in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request_headers.get("If-Modified-Since")
+    if if_modified_since:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+def file_response(f, ctype: str, filename: str, request_headers):
+    """Plan the response for an immutable output file opened as ``f``.
+
+    Handles ETag/Last-Modified (304) and single byte ranges (206/416).
+    Returns (status, headers, offset, count); ``count`` bytes of ``f``
+    starting at ``offset`` make up the body.
+    """
+    st = os.fstat(f.fileno())
+    size = st.st_size
+    etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+    last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+    }
+
+    if _not_modified(request_headers, etag, st.st_mtime):
+        return 304, headers, 0, 0
+
+    start, end = 0, size - 1
+    status = 200
+    range_header = request_headers.get("Range")
+    if_range = request_headers.get("If-Range")
+    if range_header and (not if_range or if_range in (etag, last_modified)):
+        byte_range = _parse_range(range_header, size)
+        if byte_range is None:
+            return 416, {"Content-Range": f"bytes */{size}", "Content-Length": "0"}, 0, 0
+        if byte_range:
+            start, end = byte_range
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    headers.update({
+        "Content-Type": ctype,
+        "Content-Length": str(end - start + 1),
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    })
+    return status, headers, start, end - start + 1
+
+
+def _parse_range(header: str, size: int):
+    """Parse a single ``bytes=`` Range header.
+
+    Returns (start, end) inclusive, () if the header should be ignored
+    (malformed, reversed or multi-range), or None if it is unsatisfiable
+    (starts past the end, or an empty suffix or file).
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return ()
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0 or size == 0:
+                return None
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return ()
+    if last and end < start:
+        return ()  # syntactically invalid: RFC 9110 says ignore it
+    if start >= size:
+        return None
+    return start, min(end, size - 1)
+
+
+def _parse_part_headers(headers_raw: bytes):
+    """Return (name, filename) from a part's Content-Disposition header."""
+    name = None
+    filename = None
+    headers_str = headers_raw.decode("utf-8", errors="replace")
+    for line in headers_str.splitlines():
+        if "Content-Disposition" in line:
+            for seg in line.split(";"):
+                seg = seg.strip()
+                if seg.startswith("name="):
+                    name = seg[5:].strip('"')
+                elif seg.startswith("filename="):
+                    filename = seg[9:].strip('"')
+    return name, filename
+
+
+def multipart_boundary(content_type: str) -> str:
     for part in content_type.split(";"):
         part = part.strip()
         if part.startswith("boundary="):
-            boundary = part[9:].strip('"')
-            break
-
-    if not boundary:
-        raise ValueError("No boundary found")
-
-    result = {}
-    delim = ("--" + boundary).encode()
-    parts = body.split(delim)
-
-    for part in parts[1:]:
-        if part.strip() in (b"", b"--", b"--\r\n"):
-            continue
-        part = part.lstrip(b"\r\n")
-        if b"\r\n\r\n" not in part:
-            continue
-        headers_raw, content = part.split(b"\r\n\r\n", 1)
-        # Strip exactly the trailing CRLF that precedes the next boundary marker
-        if content.endswith(b"\r\n"):
-            content = content[:-2]
-
-        headers_str = headers_raw.decode("utf-8", errors="replace")
-        name = None
-        filename = None
-        for line in headers_str.splitlines():
-            if "Content-Disposition" in line:
-                for seg in line.split(";"):
-                    seg = seg.strip()
-                    if seg.startswith("name="):
-                        name = seg[5:].strip('"')
-                    elif seg.startswith("filename="):
-                        filename = seg[9:].strip('"')
-
-        if name:
-            if filename:
-                result[name] = {"filename": filename, "data": content}
+            return part[9:].strip('"')
+    raise ValueError("No boundary found")
+
+
+class MultipartParser:
+    """Push-style incremental multipart/form-data parser.
+
+    ``feed()`` accepts the body in arbitrary chunks and scans for the
+    boundary across chunk edges. Text fields end up as strings; file parts
+    are written straight to a temp file (and SHA-256 hashed on the way) as
+    ``{"filename", "path", "size", "sha256"}``, so memory use stays
+    constant regardless of upload size.
+    """
+
+    def __init__(self, boundary: str):
+        # Every delimiter after the first is preceded by CRLF; seeding the
+        # buffer with one lets the same marker match the opening boundary.
+        self.delim = b"\r\n--" + boundary.encode()
+        self.buf = bytearray(b"\r\n")
+        self.state = "preamble"
+        self.result = {}
+        self.files = []
+        self.part = None
+
+    def feed(self, data: bytes):
+        self.buf += data
+        while self._step():
+            pass
+
+    def finish(self) -> dict:
+        if self.state != "done":
+            raise ValueError("Missing closing boundary")
+        return self.result
+
+    def abort(self):
+        """Close and delete any temp files written so far."""
+        for f in self.files:
+            f.close()
+            try: os.unlink(f.name)
+            except OSError: pass
+        self.files = []
+
+    def _step(self) -> bool:
+        buf = self.buf
+        if self.state == "preamble":
+            idx = buf.find(self.delim)
+            if idx == -1:
+                del buf[:-len(self.delim)]
+                return False
+            del buf[:idx + len(self.delim)]
+            self.state = "delimiter"
+            return True
+
+        if self.state == "delimiter":
+            if len(buf) < 2:
+                return False
+            if buf.startswith(b"--"):
+                self.state = "done"  # closing delimiter; ignore the epilogue
+                buf.clear()
+                return False
+            eol = buf.find(b"\r\n")
+            if eol == -1:
+                if len(buf) > MAX_PART_HEADER_BYTES:
+                    raise ValueError("Malformed boundary line")
+                return False
+            del buf[:eol + 2]  # transport padding + CRLF
+            self.state = "headers"
+            return True
+
+        if self.state == "headers":
+            idx = buf.find(b"\r\n\r\n")
+            if idx == -1:
+                if len(buf) > MAX_PART_HEADER_BYTES:
+                    raise ValueError("Part headers too large")
+                return False
+            self._start_part(bytes(buf[:idx]))
+            del buf[:idx + 4]
+            self.state = "body"
+            return True
+
+        if self.state == "body":
+            idx = buf.find(self.delim)
+            if idx == -1:
+                # Hold back enough bytes to catch a delimiter split across chunks
+                keep = len(self.delim) - 1
+                if len(buf) > keep:
+                    self._write(buf[:-keep])
+                    del buf[:-keep]
+                return False
+            self._write(buf[:idx])
+            del buf[:idx + len(self.delim)]
+            self._finish_part()
+            self.state = "delimiter"
+            return True
+
+        if self.state == "done":
+            buf.clear()
+        return False
+
+    def _start_part(self, headers_raw: bytes):
+        import tempfile
+        name, filename = _parse_part_headers(headers_raw)
+        # A repeated file field would replace (and orphan) the first temp file
+        if name in self.result and (filename or isinstance(self.result[name], dict)):
+            raise ValueError(f"Duplicate file field: {name}")
+        part = {"name": name, "filename": filename}
+        if name and filename:
+            suffix = Path(filename).suffix or ".mp4"
+            part["file"] = tempfile.NamedTemporaryFile(suffix=suffix, delete=False, dir=SPOOL_DIR)
+            part["size"] = 0
+            part["digest"] = hashlib.sha256()
+            self.files.append(part["file"])
+        else:
+            part["data"] = bytearray()
+        self.part = part
+
+    def _write(self, data):
+        part = self.part
+        if "file" in part:
+            part["size"] += len(data)
+            part["digest"].update(data)
+            part["file"].write(data)
+        else:
+            part["data"] += data
+            if len(part["data"]) > MAX_FIELD_BYTES:
+                raise ValueError("Form field too large")
+
+    def _finish_part(self):
+        part, self.part = self.part, None
+        if "file" in part:
+            part["file"].close()
+            self.result[part["name"]] = {"filename": part["filename"], "path": part["file"].name,
+                                         "size": part["size"], "sha256": part["digest"].hexdigest()}
+        elif part["name"]:
+            self.result[part["name"]] = part["data"].decode("utf-8", errors="replace").strip()
+
+
+def parse_multipart(rfile, content_length: int, content_type: str) -> dict:
+    """Read ``content_length`` bytes of multipart/form-data from ``rfile``
+    in UPLOAD_CHUNK_BYTES chunks and feed them to a MultipartParser."""
+    parser = MultipartParser(multipart_boundary(content_type))
+    remaining = content_length
+    try:
+        while remaining > 0:
+            chunk = rfile.read(min(UPLOAD_CHUNK_BYTES, remaining))
+            if not chunk:
+                raise ValueError("Upload ended early")
+            remaining -= len(chunk)
+            parser.feed(chunk)
+        return parser.finish()
+    except Exception:
+        parser.abort()
+        raise
+
+
+def _discard_uploads(params: dict):
+    """Delete any temp files parse_multipart spooled for ``params``."""
+    for value in params.values():
+        if isinstance(value, dict) and os.path.exists(value.get("path", "")):
+            try: os.unlink(value["path"])
+            except OSError: pass
+
+
+def _parse_seconds(value: str, field: str):
+    value = value.strip()
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise ValueError(f"Invalid {field} time: {value!r}")
+    if seconds < 0:
+        raise ValueError(f"{field.capitalize()} time must not be negative")
+    return seconds
+
+
+def conversion_options(params: dict) -> dict:
+    """Validate the /convert form fields and return them in canonical form."""
+    try:
+        fps = int(params.get("fps", "15"))
+        loop = int(params.get("loop", "0"))
+    except ValueError:
+        raise ValueError("fps and loop must be whole numbers")
+    if fps < 1:
+        raise ValueError("fps must be at least 1")
+    if not -1 <= loop <= 65535:
+        raise ValueError("loop must be between -1 (play once) and 65535")
+    width = params.get("width", "640").strip()
+    if width != "original" and not (width.isdigit() and int(width) >= 2):
+        raise ValueError(f"Invalid width: {width!r}")
+    encoder = params.get("encoder", "ffmpeg-high")
+    if encoder not in ENCODERS:
+        raise ValueError(f"Unknown encoder: {encoder}")
+    fmt = params.get("format", "").strip().lower() or "gif"
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    if encoder == "libvips" and fmt not in ("gif", "webp"):
+        raise ValueError("The libvips encoder writes gif and webp only")
+    palette_mode = None
+    palette_samples = None
+    palette_metrics = False
+    segments = None
+    if encoder == "ffmpeg-high" and fmt == "gif":
+        palette_mode = params.get("palette_mode", "").strip() or PALETTE_MODE
+        if palette_mode not in PALETTE_MODES:
+            raise ValueError(f"Unknown palette_mode: {palette_mode}")
+        if palette_mode == "sampled":
+            samples = params.get("palette_samples", "").strip() or str(PALETTE_SAMPLES)
+            if not samples.isdigit() or not 2 <= int(samples) <= 256:
+                raise ValueError("palette_samples must be between 2 and 256")
+            palette_samples = int(samples)
+            palette_metrics = params.get("palette_metrics", "").strip().lower() in ("1", "true", "on", "yes")
+        if palette_mode != "single-pass":
+            count = params.get("segments", "").strip() or str(SEGMENTS)
+            if not count.isdigit() or not 1 <= int(count) <= 64:
+                raise ValueError("segments must be between 1 and 64")
+            segments = int(count)
+    dedupe = params.get("dedupe", "").strip().lower() in ("1", "true", "on", "yes")
+    previews = params.get("previews", "").strip().lower()
+    previews = previews in ("1", "true", "on", "yes") if previews else PREVIEWS_ENABLED
+    max_bytes = params.get("max_bytes", "").strip()
+    if max_bytes:
+        if not max_bytes.isdigit() or int(max_bytes) < 64 * 1024:
+            raise ValueError("max_bytes must be a whole number of bytes, at least 64 KB")
+        if MAX_OUTPUT_BYTES and int(max_bytes) >= MAX_OUTPUT_BYTES:
+            raise ValueError(f"max_bytes must be below the {MAX_OUTPUT_BYTES // 1024 ** 2} MB output limit")
+        if encoder != "ffmpeg-high" or fmt != "gif":
+            raise ValueError("max_bytes requires the ffmpeg-high encoder and gif format")
+        max_bytes = int(max_bytes)
+    else:
+        max_bytes = None
+    start = _parse_seconds(params.get("start", ""), "start")
+    end = _parse_seconds(params.get("end", ""), "end")
+    if start is not None and end is not None and end <= start:
+        raise ValueError("End time must be after start time")
+    return {
+        "fps": fps,
+        "width": width,
+        "start": start,
+        "end": end,
+        "encoder": encoder,
+        "format": fmt,
+        "loop": loop,
+        "palette_mode": palette_mode,
+        "palette_samples": palette_samples,
+        "palette_metrics": palette_metrics,
+        "segments": segments,
+        "max_bytes": max_bytes,
+        "dedupe": dedupe,
+        "previews": previews,
+    }
+
+
+def batch_options(form: dict) -> dict:
+    """conversion_options for one batch variant.
+
+    Every variant is a branch of one ffmpeg filtergraph, so ffmpeg-high
+    variants always build their palette in-graph (single-pass).
+    """
+    opts = conversion_options(form)
+    if opts["encoder"] not in ("ffmpeg-high", "ffmpeg-med"):
+        raise ValueError("Batch variants support the ffmpeg-high and ffmpeg-med encoders")
+    if opts["max_bytes"]:
+        raise ValueError("Batch variants can't use max_bytes")
+    if opts["format"] != "gif":
+        raise ValueError("Batch variants produce gif only")
+    if opts["encoder"] == "ffmpeg-high":
+        opts.update(palette_mode="single-pass", palette_samples=None,
+                    palette_metrics=False, segments=None)
+    opts["previews"] = False
+    return opts
+
+
+def batch_forms(params: dict):
+    """The form fields of each variant of a batch request, or None.
+
+    ``variants`` is a JSON list of option objects (e.g. ``[{"width": 320},
+    {"width": 640, "fps": 10}]``), each merged over the request's own
+    fields. Variants share the upload and its start/end window.
+    """
+    raw = params.get("variants")
+    if not isinstance(raw, str) or not raw.strip():
+        return None
+    try:
+        variants = json.loads(raw)
+    except ValueError:
+        raise ValueError("variants must be a JSON list of option objects")
+    if not isinstance(variants, list) or not all(isinstance(v, dict) for v in variants):
+        raise ValueError("variants must be a JSON list of option objects")
+    if not 1 <= len(variants) <= MAX_BATCH_VARIANTS:
+        raise ValueError(f"A batch takes 1 to {MAX_BATCH_VARIANTS} variants")
+    base = {k: v for k, v in params.items() if isinstance(v, str) and k != "variants"}
+    forms = []
+    for variant in variants:
+        if {"start", "end"} & variant.keys():
+            raise ValueError("Batch variants share the request's start and end")
+        form = {**base, **{k: str(v) for k, v in variant.items()}}
+        batch_options(form)
+        forms.append(form)
+    return forms
+
+
+# ── SQLite helpers ────────────────────────────────────────────────────────────
+
+class _SQLiteFile:
+    """One autocommit connection per thread to a shared WAL database."""
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+        self.local = threading.local()
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE … COMMIT, so read-then-write steps are atomic."""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+
+# ── Metrics (/metrics) ────────────────────────────────────────────────────────
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = tuple(2 ** n for n in range(16, 30, 2))  # 64 KB … 256 MB
+
+# name → (type, help[, histogram buckets])
+METRICS = {
+    "gifmaker_uploads_total": ("counter", "Upload requests by result (queued, cached, invalid, busy, failed)."),
+    "gifmaker_upload_bytes": ("histogram", "Size of received upload bodies.", BYTES_BUCKETS),
+    "gifmaker_upload_seconds": ("histogram", "Time to receive and spool an upload body.", SECONDS_BUCKETS),
+    "gifmaker_queue_wait_seconds": ("histogram", "Time jobs spent queued before a worker claimed them.", SECONDS_BUCKETS),
+    "gifmaker_stage_seconds": ("histogram", "Time spent in each conversion stage.", SECONDS_BUCKETS),
+    "gifmaker_job_seconds": ("histogram", "Total conversion time by encoder.", SECONDS_BUCKETS),
+    "gifmaker_jobs_total": ("counter", "Finished conversions by encoder and status."),
+    "gifmaker_job_errors_total": ("counter", "Failed conversions by cause (input, ffmpeg, timeout, stall, limit, internal)."),
+    "gifmaker_ffmpeg_exits_total": ("counter", "ffmpeg runs by exit code."),
+    "gifmaker_ffmpeg_killed_total": ("counter", "ffmpeg runs killed by the watchdog, by reason."),
+    "gifmaker_output_bytes": ("histogram", "Size of finished outputs by encoder and format.", BYTES_BUCKETS),
+    "gifmaker_ffmpeg_cpu_seconds": ("histogram", "CPU time (user + system) of each ffmpeg run.", SECONDS_BUCKETS),
+    "gifmaker_ffmpeg_peak_rss_bytes": ("histogram", "Peak resident memory of each ffmpeg run.", BYTES_BUCKETS),
+    "gifmaker_output_evictions_total": ("counter", "Output files deleted by reason (quota, disk, age)."),
+    "gifmaker_output_evicted_bytes_total": ("counter", "Bytes of output files deleted by reason."),
+}
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: tuple) -> str:
+    if not key:
+        return ""
+    def escape(v):
+        return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in key) + "}"
+
+
+class Metrics:
+    """Counters and histograms of this process (JOB_STORE=memory)."""
+
+    def __init__(self):
+        self.values = collections.defaultdict(float)
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self._add([(name, _label_key(labels), value)])
+
+    def observe(self, name: str, value: float, **labels):
+        """Record one histogram observation (cumulative buckets, sum, count)."""
+        rows = [(f"{name}_bucket", _label_key({**labels, "le": le}), int(value <= le))
+                for le in METRICS[name][2]]
+        rows += [
+            (f"{name}_bucket", _label_key({**labels, "le": "+Inf"}), 1),
+            (f"{name}_sum", _label_key(labels), value),
+            (f"{name}_count", _label_key(labels), 1),
+        ]
+        self._add(rows)
+
+    def _add(self, rows: list):
+        with self.lock:
+            for sample, key, value in rows:
+                self.values[(sample, key)] += value
+
+    def samples(self) -> list:
+        with self.lock:
+            return list(self.values.items())
+
+    def flush(self):
+        """Nothing to write: this process's samples are all in memory."""
+
+    def render(self, gauges: list) -> str:
+        """Prometheus text exposition of every sample plus ``gauges``,
+        a list of (name, help, value) read at scrape time."""
+        families = collections.defaultdict(list)
+        for (sample, key), value in self.samples():
+            family = re.sub(r"_(bucket|sum|count)$", "", sample)
+            families[family if family in METRICS else sample].append((sample, key, value))
+
+        def order(row):
+            sample, key, _ = row
+            le = dict(key).get("le")
+            return (sample, [kv for kv in key if kv[0] != "le"],
+                    float("inf") if le in (None, "+Inf") else float(le))
+
+        lines = []
+        for name, (kind, help_text, *_) in METRICS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for sample, key, value in sorted(families.get(name, []), key=order):
+                lines.append(f"{sample}{_format_labels(key)} {float(value)!r}")
+        for name, help_text, value in gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {float(value)!r}"]
+        return "\n".join(lines) + "\n"
+
+
+class SQLiteMetrics(_SQLiteFile, Metrics):
+    """Metrics summed in the job database, so /metrics in the HTTP process
+    includes conversions run by --workers processes.
+
+    Samples add up in memory (``values``) and reach the database in one
+    transaction per flush (the heartbeat's, a scrape's, or at exit),
+    rather than one per inc/observe next to the job store's writes.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS metrics (
+            sample TEXT NOT NULL,
+            labels TEXT NOT NULL,   -- JSON list of [name, value] pairs
+            value  REAL NOT NULL,
+            PRIMARY KEY (sample, labels)
+        );
+    """
+
+    def __init__(self, path: Path):
+        _SQLiteFile.__init__(self, path)
+        Metrics.__init__(self)
+        self._db().executescript(self.SCHEMA)
+        atexit.register(self.flush)
+
+    def flush(self):
+        with self.lock:
+            pending, self.values = self.values, collections.defaultdict(float)
+        if not pending:
+            return
+        try:
+            with self._transaction() as db:
+                db.executemany(
+                    "INSERT INTO metrics VALUES (?, ?, ?) ON CONFLICT (sample, labels) "
+                    "DO UPDATE SET value = value + excluded.value",
+                    [(sample, json.dumps(key), value) for (sample, key), value in pending.items()])
+        except sqlite3.Error:
+            # Never fail a request or job over bookkeeping; keep the
+            # samples for the next flush
+            with self.lock:
+                for sample, value in pending.items():
+                    self.values[sample] += value
+
+    def samples(self) -> list:
+        self.flush()
+        rows = self._db().execute("SELECT sample, labels, value FROM metrics").fetchall()
+        return [((sample, tuple(tuple(kv) for kv in json.loads(labels))), value)
+                for sample, labels, value in rows]
+
+
+def make_metrics():
+    if JOB_STORE == "sqlite":
+        return SQLiteMetrics(JOB_DB_PATH)
+    return Metrics()
+
+
+metrics = make_metrics()
+
+
+class StageTimer:
+    """Times consecutive stages of one conversion into gifmaker_stage_seconds."""
+
+    def __init__(self):
+        self.stage = None
+        self.started = None
+
+    def start(self, stage: str):
+        self.stop()
+        self.stage, self.started = stage, time.monotonic()
+
+    def stop(self):
+        if self.stage:
+            metrics.observe("gifmaker_stage_seconds", time.monotonic() - self.started, stage=self.stage)
+        self.stage = None
+
+
+def error_cause(e: Exception) -> str:
+    """Bucket a conversion failure for gifmaker_job_errors_total."""
+    if isinstance(e, subprocess.TimeoutExpired):
+        return "timeout"
+    if isinstance(e, RuntimeError) and str(e).startswith("ffmpeg stalled"):
+        return "stall"
+    if isinstance(e, RuntimeError) and str(e).startswith("Job limit exceeded"):
+        return "limit"
+    if isinstance(e, ValueError):
+        return "input"
+    if isinstance(e, RuntimeError):
+        return "ffmpeg"
+    return "internal"
+
+
+def server_stats() -> dict:
+    """The /stats body: result cache and output store figures."""
+    return {"cache": result_cache.stats(), "outputs": output_store.stats()}
+
+
+def metrics_text() -> str:
+    outputs = output_store.stats()
+    cache = result_cache.stats()
+    return metrics.render([
+        ("gifmaker_output_dir_bytes", "Bytes of finished outputs in OUTPUT_DIR.", outputs["bytes"]),
+        ("gifmaker_output_dir_files", "Finished output files in OUTPUT_DIR.", outputs["files"]),
+        ("gifmaker_output_quota_bytes", "OUTPUT_QUOTA_BYTES (0: no quota).", outputs["quota_bytes"]),
+        ("gifmaker_disk_free_bytes", "Free bytes on the OUTPUT_DIR disk.", shutil.disk_usage(OUTPUT_DIR).free),
+        ("gifmaker_queue_length", "Jobs waiting for a worker.", job_store.queue_length()),
+        ("gifmaker_result_cache_bytes", "Bytes of GIFs held by the result cache.", cache["bytes"]),
+        ("gifmaker_result_cache_hits", "Result cache hits in this process.", cache["hits"]),
+    ])
+
+
+# ── Result cache ──────────────────────────────────────────────────────────────
+
+def cache_key(content_sha256: str, opts: dict) -> str:
+    """Key a conversion by the uploaded bytes plus its normalized options."""
+    blob = content_sha256 + json.dumps(opts, sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def result_files(result: dict) -> list:
+    """Every OUTPUT_DIR file a finished job result refers to."""
+    return [result[k] for k in ("filename", "poster", "preview") if result.get(k)]
+
+
+class ResultCache:
+    """LRU map of cache key → finished job result, bounded by GIF bytes.
+
+    Cached outputs are exempt from the age sweep in _cleanup_loop, but not
+    from the output store's quota; an entry whose file the store evicted
+    is dropped on its next lookup. An entry evicted here simply falls back
+    under the normal age limit.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and (OUTPUT_DIR / entry["result"]["filename"]).exists():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return dict(entry["result"])
+            if entry:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, key: str, result: dict, nbytes: int):
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = {"result": dict(result), "bytes": nbytes}
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes and self.entries:
+                self._drop(next(iter(self.entries)))
+
+    def filenames(self) -> set:
+        with self.lock:
+            return {name for e in self.entries.values() for name in result_files(e["result"])}
+
+    def discard_missing(self):
+        """Forget entries whose GIF has been deleted from OUTPUT_DIR."""
+        with self.lock:
+            for key in [k for k, e in self.entries.items()
+                        if not (OUTPUT_DIR / e["result"]["filename"]).exists()]:
+                self._drop(key)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.total_bytes,
+                    "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+    def _drop(self, key: str):
+        self.total_bytes -= self.entries.pop(key)["bytes"]
+
+
+class SQLiteResultCache(_SQLiteFile):
+    """ResultCache kept in the job database, shared by every process.
+
+    Used with JOB_STORE=sqlite so a GIF rendered by any worker process
+    serves cache hits in the HTTP process. Hit/miss counters are
+    per process.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS results (
+            key       TEXT PRIMARY KEY,
+            result    TEXT NOT NULL,   -- finished job record (JSON)
+            bytes     INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+    """
+
+    def __init__(self, path: Path, max_bytes: int):
+        super().__init__(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._db().executescript(self.SCHEMA)
+
+    def get(self, key: str):
+        db = self._db()
+        row = db.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+        result = json.loads(row[0]) if row else None
+        if result and (OUTPUT_DIR / result["filename"]).exists():
+            db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return result
+        if result:
+            db.execute("DELETE FROM results WHERE key = ?", (key,))
+        self.misses += 1
+        return None
+
+    def put(self, key: str, result: dict, nbytes: int):
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                       (key, json.dumps(result), nbytes, time.time()))
+            (total,) = db.execute("SELECT COALESCE(SUM(bytes), 0) FROM results").fetchone()
+            for old_key, old_bytes in db.execute(
+                    "SELECT key, bytes FROM results ORDER BY last_used").fetchall():
+                if total <= self.max_bytes:
+                    break
+                db.execute("DELETE FROM results WHERE key = ?", (old_key,))
+                total -= old_bytes
+
+    def filenames(self) -> set:
+        rows = self._db().execute("SELECT result FROM results").fetchall()
+        return {name for r in rows for name in result_files(json.loads(r[0]))}
+
+    def discard_missing(self):
+        db = self._db()
+        for key, result in db.execute("SELECT key, result FROM results").fetchall():
+            if not (OUTPUT_DIR / json.loads(result)["filename"]).exists():
+                db.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def stats(self) -> dict:
+        entries, total = self._db().execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM results").fetchone()
+        return {"entries": entries, "bytes": total, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses}
+
+
+def make_result_cache():
+    if JOB_STORE == "sqlite":
+        return SQLiteResultCache(JOB_DB_PATH, RESULT_CACHE_MAX_BYTES)
+    return ResultCache(RESULT_CACHE_MAX_BYTES)
+
+
+result_cache = make_result_cache()
+
+
+# ── Output store ──────────────────────────────────────────────────────────────
+
+def _output_job(name: str) -> str:
+    """The job an OUTPUT_DIR file belongs to: ``<job>.gif``, ``<job>_poster.jpg``…"""
+    return re.split(r"[._]", name, maxsplit=1)[0]
+
+
+def _scan_outputs() -> dict:
+    """name → (bytes, mtime) of every servable file in OUTPUT_DIR."""
+    found = {}
+    for entry in os.scandir(OUTPUT_DIR):
+        if Path(entry.name).suffix in OUTPUT_TYPES:
+            try: st = entry.stat()
+            except OSError: continue
+            found[entry.name] = (st.st_size, st.st_mtime)
+    return found
+
+
+def _evict_outputs(victims: list, reason: str) -> int:
+    """Delete evicted ``(name, bytes)`` files and forget the result cache
+    entries that pointed at them. Returns the bytes freed."""
+    if not victims:
+        return 0
+    for name, _ in victims:
+        try: (OUTPUT_DIR / name).unlink()
+        except OSError: pass
+    result_cache.discard_missing()
+    nbytes = sum(size for _, size in victims)
+    metrics.inc("gifmaker_output_evictions_total", len(victims), reason=reason)
+    metrics.inc("gifmaker_output_evicted_bytes_total", nbytes, reason=reason)
+    return nbytes
+
+
+class OutputStore:
+    """Running byte total of the finished outputs in OUTPUT_DIR.
+
+    Files are grouped by job (an output plus its poster and preview) and
+    kept in last-access order: a job is touched when it finishes, on every
+    /output/ hit and on every result cache hit. Finishing a job evicts the
+    least recently accessed others until the total fits ``quota``.
+    """
+
+    def __init__(self, quota: int):
+        self.quota = quota
+        self.jobs = collections.OrderedDict()  # job → {"files": {name: bytes}, "accessed": t}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def sync(self):
+        """Load what is already in OUTPUT_DIR at startup, each job last
+        accessed at its newest file's mtime."""
+        jobs = {}
+        for name, (size, mtime) in _scan_outputs().items():
+            entry = jobs.setdefault(_output_job(name), {"files": {}, "accessed": mtime})
+            entry["files"][name] = size
+            entry["accessed"] = max(entry["accessed"], mtime)
+        with self.lock:
+            self.jobs = collections.OrderedDict(sorted(jobs.items(), key=lambda kv: kv[1]["accessed"]))
+            self.total_bytes = sum(sum(e["files"].values()) for e in self.jobs.values())
+
+    def add(self, names: list) -> int:
+        """Track newly finished files, then evict down to the quota (never
+        the jobs just added). Returns the bytes evicted."""
+        sizes = {}
+        for name in names:
+            try: sizes[name] = (OUTPUT_DIR / name).stat().st_size
+            except OSError: pass
+        now = time.time()
+        with self.lock:
+            for name, size in sizes.items():
+                entry = self.jobs.setdefault(_output_job(name), {"files": {}, "accessed": now})
+                self.total_bytes += size - entry["files"].get(name, 0)
+                entry["files"][name] = size
+            added = {_output_job(name) for name in sizes}
+            for job in added:
+                self.jobs[job]["accessed"] = now
+                self.jobs.move_to_end(job)
+            victims = []
+            if self.quota:
+                for job in list(self.jobs):
+                    if self.total_bytes <= self.quota:
+                        break
+                    if job not in added:
+                        victims += self._drop(job)
+        return _evict_outputs(victims, "quota")
+
+    def touch(self, name: str):
+        with self.lock:
+            entry = self.jobs.get(_output_job(name))
+            if entry and name in entry["files"]:
+                entry["accessed"] = time.time()
+                self.jobs.move_to_end(_output_job(name))
+
+    def make_room(self, free_bytes: int) -> bool:
+        """Evict least recently accessed jobs until OUTPUT_DIR's disk has
+        ``free_bytes`` free. False, evicting nothing, if even an empty
+        store wouldn't be enough."""
+        if shutil.disk_usage(OUTPUT_DIR).free + self.stats()["bytes"] < free_bytes:
+            return False
+        while shutil.disk_usage(OUTPUT_DIR).free < free_bytes:
+            with self.lock:
+                victims = self._drop(next(iter(self.jobs))) if self.jobs else None
+            if victims is None:
+                return False
+            _evict_outputs(victims, "disk")
+        return True
+
+    def expire(self, cutoff: float, exempt: set) -> int:
+        """Evict jobs last accessed before ``cutoff`` unless one of their
+        files is in ``exempt``. Returns the bytes evicted."""
+        with self.lock:
+            victims = []
+            for job, entry in list(self.jobs.items()):
+                if entry["accessed"] >= cutoff:
+                    break
+                if not exempt & entry["files"].keys():
+                    victims += self._drop(job)
+        return _evict_outputs(victims, "age")
+
+    def names(self) -> set:
+        with self.lock:
+            return {name for e in self.jobs.values() for name in e["files"]}
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"jobs": len(self.jobs), "files": sum(len(e["files"]) for e in self.jobs.values()),
+                    "bytes": self.total_bytes, "quota_bytes": self.quota}
+
+    def _drop(self, job: str) -> list:
+        files = self.jobs.pop(job)["files"]
+        self.total_bytes -= sum(files.values())
+        return list(files.items())
+
+
+class SQLiteOutputStore(_SQLiteFile):
+    """OutputStore kept in the job database, so files written by worker
+    processes and /output/ hits in the HTTP process share one LRU."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS outputs (
+            name     TEXT PRIMARY KEY,
+            job      TEXT NOT NULL,
+            bytes    INTEGER NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS outputs_job ON outputs (job);
+    """
+    TOUCH_INTERVAL = 10  # seconds; spares a write per range request
+
+    def __init__(self, path: Path, quota: int):
+        super().__init__(path)
+        self.quota = quota
+        self._db().executescript(self.SCHEMA)
+
+    def sync(self):
+        """Match the table to OUTPUT_DIR; new files count as accessed at their mtime."""
+        found = _scan_outputs()
+        with self._transaction() as db:
+            known = {name for (name,) in db.execute("SELECT name FROM outputs")}
+            db.executemany("DELETE FROM outputs WHERE name = ?", [(n,) for n in known - found.keys()])
+            db.executemany("INSERT OR IGNORE INTO outputs VALUES (?, ?, ?, ?)",
+                           [(n, _output_job(n), size, mtime) for n, (size, mtime) in found.items()])
+            db.executemany("UPDATE outputs SET bytes = ? WHERE name = ?",
+                           [(size, n) for n, (size, _) in found.items()])
+
+    def add(self, names: list) -> int:
+        rows = []
+        now = time.time()
+        for name in names:
+            try: rows.append((name, _output_job(name), (OUTPUT_DIR / name).stat().st_size, now))
+            except OSError: pass
+        added = {job for _, job, _, _ in rows}
+        victims = []
+        with self._transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)", rows)
+            db.executemany("UPDATE outputs SET accessed = ? WHERE job = ?", [(now, j) for j in added])
+            if self.quota:
+                (total,) = db.execute("SELECT COALESCE(SUM(bytes), 0) FROM outputs").fetchone()
+                for job, nbytes in db.execute(
+                        "SELECT job, SUM(bytes) FROM outputs GROUP BY job ORDER BY MAX(accessed)").fetchall():
+                    if total <= self.quota:
+                        break
+                    if job not in added:
+                        victims += self._drop(db, job)
+                        total -= nbytes
+        return _evict_outputs(victims, "quota")
+
+    def touch(self, name: str):
+        now = time.time()
+        self._db().execute(
+            "UPDATE outputs SET accessed = ? WHERE job = (SELECT job FROM outputs WHERE name = ?) "
+            "AND accessed < ?", (now, name, now - self.TOUCH_INTERVAL))
+
+    def make_room(self, free_bytes: int) -> bool:
+        if shutil.disk_usage(OUTPUT_DIR).free + self.stats()["bytes"] < free_bytes:
+            return False
+        while shutil.disk_usage(OUTPUT_DIR).free < free_bytes:
+            with self._transaction() as db:
+                row = db.execute("SELECT job FROM outputs GROUP BY job ORDER BY MAX(accessed) LIMIT 1").fetchone()
+                victims = self._drop(db, row[0]) if row else None
+            if victims is None:
+                return False
+            _evict_outputs(victims, "disk")
+        return True
+
+    def expire(self, cutoff: float, exempt: set) -> int:
+        victims = []
+        with self._transaction() as db:
+            for (job,) in db.execute("SELECT job FROM outputs GROUP BY job HAVING MAX(accessed) < ?",
+                                     (cutoff,)).fetchall():
+                names = {n for (n,) in db.execute("SELECT name FROM outputs WHERE job = ?", (job,))}
+                if not exempt & names:
+                    victims += self._drop(db, job)
+        return _evict_outputs(victims, "age")
+
+    def names(self) -> set:
+        return {name for (name,) in self._db().execute("SELECT name FROM outputs")}
+
+    def stats(self) -> dict:
+        jobs, files, total = self._db().execute(
+            "SELECT COUNT(DISTINCT job), COUNT(*), COALESCE(SUM(bytes), 0) FROM outputs").fetchone()
+        return {"jobs": jobs, "files": files, "bytes": total, "quota_bytes": self.quota}
+
+    @staticmethod
+    def _drop(db, job: str) -> list:
+        victims = db.execute("SELECT name, bytes FROM outputs WHERE job = ?", (job,)).fetchall()
+        db.execute("DELETE FROM outputs WHERE job = ?", (job,))
+        return victims
+
+
+def make_output_store():
+    if JOB_STORE == "sqlite":
+        return SQLiteOutputStore(JOB_DB_PATH, OUTPUT_QUOTA_BYTES)
+    return OutputStore(OUTPUT_QUOTA_BYTES)
+
+
+output_store = make_output_store()
+
+
+def disk_has_room(nbytes: int) -> bool:
+    """Whether an ``nbytes`` upload and its job leave MIN_FREE_DISK_BYTES
+    free on the output and spool disks, evicting old outputs if need be."""
+    if not MIN_FREE_DISK_BYTES:
+        return True
+    need = MIN_FREE_DISK_BYTES + nbytes
+    if not output_store.make_room(need):
+        return False
+    return shutil.disk_usage(SPOOL_DIR).free >= need
+
+
+# ── Job store ─────────────────────────────────────────────────────────────────
+
+FINISHED = ("done", "error")
+
+
+def process_owner() -> str:
+    """Identifies this process as the owner of the jobs it runs."""
+    return f"{socket.gethostname()}:{os.getpid()}:{PROCESS_TOKEN}"
+
+
+def claim_owner() -> str:
+    """process_owner() plus a suffix unique to one claim, so a job this
+    process claims again after a requeue has a different owner."""
+    return f"{process_owner()}:{uuid.uuid4().hex[:8]}"
+
+
+def _upload_present(params: dict) -> bool:
+    video = params.get("video")
+    return isinstance(video, dict) and os.path.exists(video.get("path", ""))
+
+
+class MemoryJobStore:
+    """Job records and FIFO in this process only (JOB_STORE=memory)."""
+
+    shared = False
+
+    def __init__(self):
+        self.records = {}
+        self.params = {}
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+
+    def get(self, job_id: str):
+        with self.lock:
+            record = self.records.get(job_id)
+            return dict(record) if record is not None else None
+
+    def put(self, job_id: str, record: dict, owner=None) -> bool:
+        with self.lock:
+            self.records[job_id] = record
+        return True
+
+    def enqueue(self, job_id: str, record: dict, params: dict, max_queued: int) -> bool:
+        with self.lock:
+            if len(self.queue) >= max_queued:
+                return False
+            self.records[job_id] = record
+            self.params[job_id] = params
+            self.queue.append(job_id)
+            return True
+
+    def claim(self, owner: str):
+        with self.lock:
+            if not self.queue:
+                return None
+            job_id = self.queue.popleft()
+            return job_id, self.params.pop(job_id)
+
+    def queue_length(self) -> int:
+        with self.lock:
+            return len(self.queue)
+
+    def queue_position(self, job_id: str) -> int:
+        with self.lock:
+            try:
+                return self.queue.index(job_id) + 1
+            except ValueError:
+                return 0
+
+    def trim(self, max_jobs: int):
+        """Drop the 50 oldest finished jobs once there are max_jobs records."""
+        with self.lock:
+            if len(self.records) >= max_jobs:
+                finished = [k for k, v in self.records.items() if v.get("status") in FINISHED]
+                for k in finished[:50]:
+                    self.records.pop(k, None)
+
+    def prune(self, keep_finished: int):
+        with self.lock:
+            finished = [k for k, v in self.records.items() if v.get("status") in FINISHED]
+            for k in finished[:max(0, len(finished) - keep_finished)]:
+                self.records.pop(k, None)
+
+    def heartbeat(self, owner: str):
+        pass  # jobs can't outlive this process
+
+    def requeue_stale(self, max_age: float) -> int:
+        return 0
+
+    def requeue_owner(self, owner_prefix: str) -> int:
+        return 0
+
+
+class SQLiteJobStore(_SQLiteFile):
+    """Job records and FIFO in a SQLite database (WAL mode).
+
+    Every server process on the host can use the same file: /status works
+    for any job, and workers in any process claim queued jobs atomically.
+    Running jobs carry their owner's heartbeat; if it goes stale (the
+    process crashed or was redeployed) the job is requeued.
+    """
+
+    shared = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id           TEXT PRIMARY KEY,
+            status       TEXT NOT NULL,   -- queued | running | done | error
+            record       TEXT NOT NULL,   -- JSON served by /status
+            params       TEXT,            -- JSON form fields + spooled upload, until finished
+            owner        TEXT,            -- claim_owner() of the running worker's claim
+            created_at   REAL NOT NULL,
+            started_at   REAL,
+            heartbeat_at REAL,
+            updated_at   REAL NOT NULL,
+            finished_at  REAL,
+            attempts     INTEGER NOT NULL DEFAULT 0   -- times a worker claimed it
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+    """
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        db = self._db()
+        db.executescript(self.SCHEMA)
+        columns = {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+        if "attempts" not in columns:  # databases created before worker processes
+            db.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+    def get(self, job_id: str):
+        row = self._db().execute("SELECT record FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, job_id: str, record: dict, owner=None) -> bool:
+        """Store a record. With ``owner`` (a claim's), only while that claim
+        still holds the job: a worker that stalled past a requeue must not
+        overwrite its successor's record. Returns whether it was written."""
+        now = time.time()
+        status = record.get("status", "running")
+        finished_at = now if status in FINISHED else None
+        if owner is not None:
+            cursor = self._db().execute(
+                """UPDATE jobs SET status = ?, record = ?, updated_at = ?, finished_at = ?,
+                       params = CASE WHEN ? IN ('done', 'error') THEN NULL ELSE params END
+                   WHERE id = ? AND owner = ?""",
+                (status, json.dumps(record), now, finished_at, status, job_id, owner))
+            return cursor.rowcount > 0
+        self._db().execute(
+            """INSERT INTO jobs (id, status, record, created_at, updated_at, finished_at)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT (id) DO UPDATE SET
+                   status = excluded.status, record = excluded.record,
+                   updated_at = excluded.updated_at, finished_at = excluded.finished_at,
+                   params = CASE WHEN excluded.status IN ('done', 'error') THEN NULL ELSE params END""",
+            (job_id, status, json.dumps(record), now, now, finished_at))
+        return True
+
+    def enqueue(self, job_id: str, record: dict, params: dict, max_queued: int) -> bool:
+        now = time.time()
+        with self._transaction() as db:
+            (queued,) = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()
+            if queued >= max_queued:
+                return False
+            db.execute(
+                """INSERT INTO jobs (id, status, record, params, created_at, updated_at)
+                   VALUES (?, 'queued', ?, ?, ?, ?)""",
+                (job_id, json.dumps(record), json.dumps(params), now, now))
+        return True
+
+    def claim(self, owner: str):
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                """SELECT id, params FROM jobs WHERE status = 'queued'
+                   ORDER BY created_at, rowid LIMIT 1""").fetchone()
+            if row is None:
+                return None
+            db.execute(
+                """UPDATE jobs SET status = 'running', record = ?, owner = ?,
+                       started_at = ?, heartbeat_at = ?, updated_at = ?,
+                       attempts = attempts + 1
+                   WHERE id = ?""",
+                (json.dumps({"status": "running", "step": "Starting…"}), owner, now, now, now, row[0]))
+        return row[0], json.loads(row[1])
+
+    def queue_length(self) -> int:
+        (n,) = self._db().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()
+        return n
+
+    def queue_position(self, job_id: str) -> int:
+        row = self._db().execute(
+            """SELECT COUNT(*) FROM jobs AS q, jobs AS j
+               WHERE j.id = ? AND j.status = 'queued' AND q.status = 'queued'
+                 AND (q.created_at < j.created_at
+                      OR (q.created_at = j.created_at AND q.rowid <= j.rowid))""",
+            (job_id,)).fetchone()
+        return row[0]
+
+    def trim(self, max_jobs: int):
+        db = self._db()
+        (n,) = db.execute("SELECT COUNT(*) FROM jobs").fetchone()
+        if n >= max_jobs:
+            db.execute(
+                """DELETE FROM jobs WHERE id IN (
+                       SELECT id FROM jobs WHERE status IN ('done', 'error')
+                       ORDER BY finished_at LIMIT 50)""")
+
+    def prune(self, keep_finished: int):
+        self._db().execute(
+            """DELETE FROM jobs WHERE status IN ('done', 'error') AND id NOT IN (
+                   SELECT id FROM jobs WHERE status IN ('done', 'error')
+                   ORDER BY finished_at DESC LIMIT ?)""",
+            (keep_finished,))
+
+    def heartbeat(self, owner: str):
+        self._db().execute(
+            "UPDATE jobs SET heartbeat_at = ? WHERE owner LIKE ? || ':%' AND status = 'running'",
+            (time.time(), owner))
+
+    def requeue_stale(self, max_age: float) -> int:
+        """Requeue running jobs whose owner stopped heartbeating."""
+        return self._requeue("heartbeat_at < ?", (time.time() - max_age,))
+
+    def requeue_owner(self, owner_prefix: str) -> int:
+        """Requeue the running jobs of a worker process known to be dead."""
+        return self._requeue("owner LIKE ? || '%'", (owner_prefix,))
+
+    def _requeue(self, where: str, args: tuple) -> int:
+        """Put matching running jobs back in the queue at their old place.
+
+        A job fails instead if its spooled upload is gone, or if it has
+        already taken down JOB_MAX_ATTEMPTS workers.
+        """
+        now = time.time()
+        requeued = 0
+        with self._transaction() as db:
+            rows = db.execute(
+                f"SELECT id, params, attempts FROM jobs WHERE status = 'running' AND {where}",
+                args).fetchall()
+            for job_id, params_json, attempts in rows:
+                params = json.loads(params_json or "{}")
+                if _upload_present(params) and attempts < JOB_MAX_ATTEMPTS:
+                    db.execute(
+                        """UPDATE jobs SET status = 'queued', record = ?, owner = NULL,
+                               started_at = NULL, heartbeat_at = NULL, updated_at = ?
+                           WHERE id = ?""",
+                        (json.dumps({"status": "queued", "step": "Queued…"}), now, job_id))
+                    requeued += 1
+                    continue
+                if attempts >= JOB_MAX_ATTEMPTS:
+                    error = "Conversion crashed the worker repeatedly. Try a shorter clip or smaller width."
+                else:
+                    error = "Job was interrupted by a server restart. Please try again."
+                db.execute(
+                    """UPDATE jobs SET status = 'error', record = ?, params = NULL,
+                           updated_at = ?, finished_at = ? WHERE id = ?""",
+                    (json.dumps({"status": "error", "error": error}), now, now, job_id))
+                _discard_uploads(params)
+        return requeued
+
+
+def make_job_store():
+    if JOB_STORE == "memory":
+        return MemoryJobStore()
+    if JOB_STORE == "sqlite":
+        return SQLiteJobStore(JOB_DB_PATH)
+    raise ValueError(f"Unknown JOB_STORE: {JOB_STORE}")
+
+
+job_store = make_job_store()
+
+
+# ── Job state ─────────────────────────────────────────────────────────────────
+
+class JobEvents:
+    """Wakeups for the threaded server's /events listeners, per job id.
+
+    Only ids with a listener are tracked. A progress update wakes the
+    listeners of that one job instead of every open stream.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}  # job id → {"cond", "version", "listeners"}
+
+    @contextlib.contextmanager
+    def listen(self, job_id: str):
+        """Track ``job_id`` for the duration; yields its entry for wait()."""
+        with self.lock:
+            entry = self.jobs.setdefault(
+                job_id, {"cond": threading.Condition(self.lock), "version": 0, "listeners": 0})
+            entry["listeners"] += 1
+        try:
+            yield entry
+        finally:
+            with self.lock:
+                entry["listeners"] -= 1
+                if not entry["listeners"]:
+                    del self.jobs[job_id]
+
+    def version(self, entry: dict) -> int:
+        with self.lock:
+            return entry["version"]
+
+    def wait(self, entry: dict, version: int, timeout: float):
+        """Block until the job changes after ``version``, or timeout."""
+        with self.lock:
+            entry["cond"].wait_for(lambda: entry["version"] != version, timeout)
+
+    def notify(self, job_id):
+        with self.lock:
+            if job_id is None:
+                entries = list(self.jobs.values())
             else:
-                result[name] = content.decode("utf-8", errors="replace").strip()
+                entries = [self.jobs[job_id]] if job_id in self.jobs else []
+            for entry in entries:
+                entry["version"] += 1
+                entry["cond"].notify_all()
 
-    return result
 
+job_events = JobEvents()
+
+
+def notify_job(job_id):
+    """Wake the /events listeners of ``job_id``, or of every job for None
+    (a claim moves every queued job's position)."""
+    job_events.notify(job_id)
+    for listener in job_listeners:
+        listener(job_id)
+
+
+def set_job(job_id: str, record: dict, owner=None):
+    """Replace a job's record and wake its /events listeners. With
+    ``owner``, a write after the claim lost the job is dropped."""
+    if job_store.put(job_id, record, owner):
+        notify_job(job_id)
+
+
+def job_status(job_id: str) -> dict:
+    """The job record as served by /status and /events."""
+    job = job_store.get(job_id) or {"status": "unknown"}
+    if job.get("status") == "queued":
+        position = queue_position(job_id)
+        if position:
+            job = {**job, "position": position, "step": f"Queued (position {position})…"}
+    return job
+
+
+# ── ffmpeg helpers ────────────────────────────────────────────────────────────
+
+def probe_format(path: str) -> dict:
+    """Container ``duration`` and ``start_time`` in seconds (None if unknown)."""
+    r = subprocess.run(
+        ["ffprobe", "-v", "quiet", "-show_entries", "format=duration,start_time",
+         "-of", "json", path],
+        capture_output=True, text=True, timeout=30
+    )
+    try:
+        fmt = json.loads(r.stdout or "{}").get("format", {})
+    except ValueError:
+        fmt = {}
+    info = {}
+    for key in ("duration", "start_time"):
+        try:
+            info[key] = float(fmt[key])
+        except (KeyError, TypeError, ValueError):
+            info[key] = None
+    return info
+
+
+_probe_cache = collections.OrderedDict()
+_probe_cache_lock = threading.Lock()
+
+
+def _frame_rate(rate):
+    try:
+        num, _, den = (rate or "").partition("/")
+        value = float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+    return round(value, 3) if value > 0 else None
+
+
+def probe_media(path: str, sha256: str = None) -> dict:
+    """One ffprobe of an upload: container timing plus the first video stream.
+
+    Returns ``duration``, ``start_time``, ``codec``, ``width``/``height``
+    (as displayed, i.e. after ``rotation``), ``fps`` and ``frames``; any
+    can be None. Raises ValueError if the file can't be read or has no
+    video stream. Results are cached by ``sha256``.
+    """
+    if sha256:
+        with _probe_cache_lock:
+            if sha256 in _probe_cache:
+                _probe_cache.move_to_end(sha256)
+                return dict(_probe_cache[sha256])
+    started = time.monotonic()
+    r = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "format=duration,start_time:stream=codec_name,width,height,"
+         "avg_frame_rate,r_frame_rate,nb_frames:stream_tags=rotate:stream_side_data=rotation",
+         "-of", "json", path],
+        capture_output=True, text=True, timeout=30
+    )
+    metrics.observe("gifmaker_stage_seconds", time.monotonic() - started, stage="probe")
+    try:
+        data = json.loads(r.stdout or "{}")
+    except ValueError:
+        data = {}
+    if r.returncode != 0 or "format" not in data:
+        raise ValueError("Could not read the uploaded file as a video")
+    streams = data.get("streams") or []
+    if not streams:
+        raise ValueError("The uploaded file has no video stream")
+    fmt, stream = data["format"], streams[0]
+
+    def number(value, kind=float):
+        try:
+            return kind(value)
+        except (TypeError, ValueError):
+            return None
+
+    rotation = number((stream.get("tags") or {}).get("rotate"), int) or 0
+    for side_data in stream.get("side_data_list") or []:
+        if "rotation" in side_data:
+            rotation = number(side_data["rotation"], int) or 0
+    rotation %= 360
+    width, height = number(stream.get("width"), int), number(stream.get("height"), int)
+    if rotation in (90, 270):
+        width, height = height, width  # ffmpeg autorotates before our filters
+    media = {
+        "duration": number(fmt.get("duration")),
+        "start_time": number(fmt.get("start_time")),
+        "codec": stream.get("codec_name"),
+        "width": width,
+        "height": height,
+        "fps": _frame_rate(stream.get("avg_frame_rate")) or _frame_rate(stream.get("r_frame_rate")),
+        "rotation": rotation,
+        "frames": number(stream.get("nb_frames"), int),
+    }
+    if sha256:
+        with _probe_cache_lock:
+            _probe_cache[sha256] = media
+            while len(_probe_cache) > PROBE_CACHE_SIZE:
+                _probe_cache.popitem(last=False)
+    return dict(media)
+
+
+def limit_work(media: dict, opts: dict) -> dict:
+    """Check the requested conversion against the probed input.
+
+    Raises ValueError for work over the limits; returns form-field
+    overrides that shrink it instead where that is possible (fps above
+    the source's, width over MAX_OUTPUT_WIDTH, frames over MAX_OUTPUT_PIXELS).
+    """
+    overrides = {}
+    fps = opts["fps"]
+    if media.get("fps") and fps > media["fps"]:
+        fps = max(1, round(media["fps"]))  # higher would only repeat frames
+        overrides["fps"] = str(fps)
+    width = media.get("width") if opts["width"] == "original" else int(opts["width"])
+    if width and width > MAX_OUTPUT_WIDTH:
+        width = MAX_OUTPUT_WIDTH
+        overrides["width"] = str(width)
+    if width and media.get("width") and media.get("height"):
+        aspect = media["height"] / media["width"]
+        if width * width * aspect > MAX_OUTPUT_PIXELS:
+            width = int((MAX_OUTPUT_PIXELS / aspect) ** 0.5) // 2 * 2
+            overrides["width"] = str(max(2, width))
+
+    duration, start, end = media.get("duration"), opts["start"] or 0.0, opts["end"]
+    if duration is not None:
+        if start >= duration:
+            raise ValueError(f"Start time is past the end of the video ({duration:.1f} s)")
+        end = min(end, duration) if end is not None else duration
+    if end is not None:
+        clip = end - start
+        if clip > MAX_CLIP_SECONDS:
+            raise ValueError(f"Clip is {clip:.0f} s long; the limit is {MAX_CLIP_SECONDS} s. "
+                             "Set a start and end time.")
+        if clip * fps > MAX_OUTPUT_FRAMES:
+            raise ValueError(f"Clip would have {clip * fps:.0f} frames; the limit is "
+                             f"{MAX_OUTPUT_FRAMES}. Lower the fps or shorten the clip.")
+    return overrides
+
+
+def prepare_clip(input_path: str, start, end, media: dict) -> dict:
+    """Check the start/end window against the input and build the time args.
+
+    Returns ``{"path", "time_args", "seek", "duration", "trimmed"}``, where
+    ``seek`` is the clip's start offset within ``path``. With
+    PRETRIM_ENABLED and a start/end window, the keyframe-bounded window is
+    stream-copied (``-c copy``) to a small temp file once, so every later
+    pass demuxes only that window; ``trimmed`` is then the temp path for
+    the caller to delete. Falls back to seeking in the original upload if
+    the copy fails.
+    """
+    duration = media.get("duration")
+    if duration is not None:
+        if start is not None and start >= duration:
+            raise ValueError(f"Start time is past the end of the video ({duration:.1f} s)")
+        if end is not None and end > duration:
+            end = None  # "up to the end" — don't ask ffmpeg for more than exists
+
+    clip_duration = None
+    if duration is not None or end is not None:
+        clip_end = end if end is not None else duration
+        clip_duration = max(0.0, clip_end - (start or 0.0)) or None
+
+    def time_args(seek):
+        args = []
+        if seek:
+            args += ["-ss", f"{seek:.6f}"]
+        if clip_duration is not None and end is not None:
+            args += ["-t", f"{clip_duration:.6f}"]
+        return args
+
+    clip = {"path": input_path, "time_args": time_args(start), "seek": start or 0.0,
+            "duration": clip_duration, "trimmed": None}
+    if not PRETRIM_ENABLED or (start is None and end is None):
+        return clip
 
-def run_conversion(job_id: str, params: dict):
     import tempfile
-    import shutil
+    fd, trimmed = tempfile.mkstemp(suffix=".mkv")
+    os.close(fd)
+    # -ss before -i snaps to the keyframe at or before start; -copyts keeps
+    # the original timestamps so the exact start can be found again below.
+    # The second of slack covers B-frame reordering past the end point.
+    cmd = ["ffmpeg", "-y", "-v", "error"]
+    if start:
+        cmd += ["-ss", f"{start:.6f}"]
+    if clip_duration is not None and end is not None:
+        cmd += ["-t", f"{clip_duration + 1:.6f}"]
+    cmd += ["-i", input_path, "-map", "0:v:0", "-c", "copy", "-copyts", "-f", "matroska", trimmed]
+    try:
+        r = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+        trimmed_start = probe_format(trimmed).get("start_time") if r.returncode == 0 else None
+    except subprocess.TimeoutExpired:
+        trimmed_start = None
+    if trimmed_start is None:
+        try: os.unlink(trimmed)
+        except OSError: pass
+        return clip
+
+    # Offset of the requested start inside the keyframe-aligned window
+    seek = max(0.0, (media.get("start_time") or 0.0) + (start or 0.0) - trimmed_start)
+    return {"path": trimmed, "time_args": time_args(seek), "seek": seek,
+            "duration": clip_duration, "trimmed": trimmed}
+
+
+def _progress_seconds(value: str):
+    try:
+        return int(value) / 1_000_000
+    except ValueError:
+        return None
+
+
+_PROGRESS_LINE = re.compile(r"^[a-z0-9_]+=\S*$")
+
+
+# CPU time and peak RSS of each ffmpeg child of the current job
+# (run_conversion sets a fresh list; render_segments copies the context)
+job_usage = contextvars.ContextVar("job_usage", default=None)
+# claim_owner() of the job this worker thread is converting (None outside
+# _worker_loop, e.g. the benchmark)
+job_owner = contextvars.ContextVar("job_owner", default=None)
+
+try:
+    _prctl = ctypes.CDLL(None, use_errno=True).prctl if sys.platform.startswith("linux") else None
+except (OSError, AttributeError):
+    _prctl = None
+PR_SET_PDEATHSIG = 1
+
+
+def _limit_child():
+    """preexec_fn for ffmpeg: cap its address space, and have the kernel
+    kill it if the thread that started it dies (e.g. a killed worker)."""
+    if FFMPEG_MEMORY_LIMIT_BYTES:
+        resource.setrlimit(resource.RLIMIT_AS, (FFMPEG_MEMORY_LIMIT_BYTES, FFMPEG_MEMORY_LIMIT_BYTES))
+    if _prctl:
+        _prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+
+
+def output_limit_args() -> list:
+    """ffmpeg output options that stop writing at MAX_OUTPUT_BYTES (see check_output)."""
+    return ["-fs", str(MAX_OUTPUT_BYTES)] if MAX_OUTPUT_BYTES else []
+
+
+def dedupe_filter(fps: int, duration, label: str = "dd") -> str:
+    """mpdecimate for ``-fps_mode vfr`` output that keeps the clip's length.
+
+    mpdecimate drops a static tail outright, and the last frame it keeps
+    is then shown for a single frame interval. So the final two frames
+    (counted from ``duration``) bypass mpdecimate and are interleaved back
+    by timestamp; the run before them keeps its full delay. Two, not one:
+    the APNG muxer gives the last frame the previous frame's delay.
+    ``label`` prefixes the internal pads, unique per filtergraph.
+    """
+    if not duration:
+        return "mpdecimate"
+    # Counted short of the estimate: a count past the real end would leave
+    # the tail branch empty and lose the tail again
+    last = max(1, int(duration * fps) - 2)
+    # One timebase for both branches: interleave doesn't rescale durations
+    return (f"settb=AVTB,split[{label}a][{label}b];"
+            f"[{label}a]trim=end_frame={last},mpdecimate[{label}m];"
+            f"[{label}b]trim=start_frame={last}[{label}t];[{label}m][{label}t]interleave")
+
+
+def check_output(nbytes: int, info: dict):
+    """Fail a finished output that hit MAX_OUTPUT_BYTES (ffmpeg -fs truncates
+    it) or MAX_OUTPUT_PIXELS."""
+    if MAX_OUTPUT_BYTES and nbytes >= MAX_OUTPUT_BYTES:
+        raise RuntimeError(f"Job limit exceeded: the output reached the {MAX_OUTPUT_BYTES // 1024 ** 2} MB "
+                           "output limit. Lower the width, fps or clip length.")
+    if MAX_OUTPUT_PIXELS and info["width"] * info["height"] > MAX_OUTPUT_PIXELS:
+        raise RuntimeError(f"Job limit exceeded: {info['width']}×{info['height']} frames are over "
+                           f"the {MAX_OUTPUT_PIXELS} pixel limit")
+
+
+def _thread_args(cmd: list, outputs: list) -> list:
+    """Add FFMPEG_THREADS as decoder (per input), filter and encoder (per
+    output file in ``outputs``) thread counts."""
+    if not FFMPEG_THREADS:
+        return cmd
+    n = str(FFMPEG_THREADS)
+    args = ["-filter_threads", n, "-filter_complex_threads", n]
+    for i, arg in enumerate(cmd[1:], 1):
+        if arg == "-i" or (arg in outputs and cmd[i - 1] != "-i"):
+            args += ["-threads", n]
+        args.append(arg)
+    return [cmd[0], *args]
+
+
+def run_ffmpeg(cmd: list, timeout: float, on_progress=None, stdout_sink=None,
+               outputs=None) -> subprocess.CompletedProcess:
+    """Run ffmpeg with ``-progress`` and report each progress block.
+
+    ``on_progress`` receives a dict with ``out_time`` (seconds), ``frame``
+    and ``speed`` (× realtime). If ``stdout_sink`` is given, ffmpeg's stdout
+    is streamed to it in chunks and progress is read from stderr instead.
+    Behaves like ``subprocess.run(..., capture_output=True, text=True,
+    timeout=timeout)``; additionally kills ffmpeg if it stops making
+    progress for FFMPEG_STALL_SECONDS. The child runs under FFMPEG_THREADS
+    and FFMPEG_MEMORY_LIMIT_BYTES; its rusage goes to ``job_usage``.
+    ``outputs`` lists the command's output files, main one first (default:
+    the last argument).
+    """
+    outputs = outputs or [cmd[-1]]
+    progress_url = "pipe:2" if stdout_sink else "pipe:1"
+    cmd = _thread_args(cmd, outputs)
+    cmd = [cmd[0], "-nostats", "-progress", progress_url, *cmd[1:]]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            preexec_fn=_limit_child)
+    finished = threading.Event()
+    # Held to signal the child or to mark it finished: once it's reaped
+    # its pid can be reused, so nothing may signal it after that
+    reap_lock = threading.Lock()
+
+    started = time.monotonic()
+    last_activity = [started]
+    killed = []
+    failed = []  # an exception from on_progress on the stderr thread
+    stderr_tail = collections.deque(maxlen=200)
+    block = {}
+
+    def handle_progress(line):
+        last_activity[0] = time.monotonic()
+        key, _, value = line.strip().partition("=")
+        block[key] = value
+        if key == "progress":
+            if on_progress:
+                speed = block.get("speed", "").rstrip("x")
+                on_progress({
+                    "out_time": _progress_seconds(block.get("out_time_us", "")),
+                    "frame": int(block["frame"]) if block.get("frame", "").isdigit() else None,
+                    "speed": float(speed) if speed.replace(".", "", 1).isdigit() else None,
+                })
+            block.clear()
+
+    def kill(reason=None):
+        # os.kill, not proc.kill(): that polls, and would reap the child
+        # before wait4 can collect its rusage
+        with reap_lock:
+            if not finished.is_set():
+                if reason:
+                    killed.append(reason)
+                os.kill(proc.pid, signal.SIGKILL)
+
+    def read_stderr():
+        # Keeps draining after a failed callback, or a full pipe would block ffmpeg
+        for raw in proc.stderr:
+            line = raw.decode("utf-8", errors="replace")
+            if stdout_sink and _PROGRESS_LINE.match(line.strip()):
+                if failed:
+                    continue
+                try:
+                    handle_progress(line)
+                except Exception as e:
+                    failed.append(e)
+                    kill()
+            else:
+                stderr_tail.append(line)
+
+    def watchdog():
+        while not finished.is_set():
+            now = time.monotonic()
+            if now - started > timeout:
+                kill("timeout")
+                return
+            if now - last_activity[0] > FFMPEG_STALL_SECONDS:
+                kill("stalled")
+                return
+            finished.wait(1)
+
+    stderr_reader = threading.Thread(target=read_stderr, daemon=True)
+    stderr_reader.start()
+    threading.Thread(target=watchdog, daemon=True).start()
+
+    try:
+        if stdout_sink:
+            for chunk in iter(lambda: proc.stdout.read(UPLOAD_CHUNK_BYTES), b""):
+                last_activity[0] = time.monotonic()
+                stdout_sink(chunk)
+        else:
+            for raw in proc.stdout:
+                handle_progress(raw.decode("utf-8", errors="replace"))
+    except BaseException:
+        kill()  # nothing reads its output any more
+        raise
+    finally:
+        # Wait for the exit without reaping where the platform can, so the
+        # watchdog may still kill a child that hangs after closing stdout
+        if hasattr(os, "waitid"):
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        with reap_lock:
+            finished.set()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        stderr_reader.join(timeout=5)
+        proc.stdout.close()
+    if failed:
+        raise failed[0]
+    stderr = "".join(stderr_tail)
+
+    usage = {
+        "output": Path(outputs[0]).name,
+        "exit": proc.returncode,
+        "cpu_seconds": round(rusage.ru_utime + rusage.ru_stime, 3),
+        "peak_rss_bytes": rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+    }
+    if job_usage.get() is not None:
+        job_usage.get().append(usage)
+    metrics.observe("gifmaker_ffmpeg_cpu_seconds", usage["cpu_seconds"])
+    metrics.observe("gifmaker_ffmpeg_peak_rss_bytes", usage["peak_rss_bytes"])
+    if killed:
+        metrics.inc("gifmaker_ffmpeg_killed_total", reason=killed[0])
+    else:
+        metrics.inc("gifmaker_ffmpeg_exits_total", code=proc.returncode)
+    if "timeout" in killed:
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    if "stalled" in killed:
+        raise RuntimeError(f"ffmpeg stalled: no progress for {FFMPEG_STALL_SECONDS} s")
+    # Blame the limit only on evidence of a failed allocation (ENOMEM's
+    # message, av_malloc or an encoder's malloc); other crashes are ffmpeg's
+    if FFMPEG_MEMORY_LIMIT_BYTES and proc.returncode != 0 and re.search(
+            r"Cannot allocate memory|av_malloc|malloc of size \d+ failed", stderr):
+        raise RuntimeError(f"Job limit exceeded: ffmpeg ran out of memory "
+                           f"(limit {FFMPEG_MEMORY_LIMIT_BYTES // 1024 ** 2} MB)")
+    return subprocess.CompletedProcess(cmd, proc.returncode, "", stderr)
+
+
+class FrameSpool:
+    """Collects the RGB frames of an ffmpeg ``-f image2pipe -c:v ppm`` stream.
+
+    Frames are stacked into one vertical strip (the layout gifsave expects
+    for animations). The strip stays in memory up to ``max_memory`` bytes,
+    then spills to a single raw temp file that libvips maps with rawload,
+    so long clips never need the whole strip in RAM.
+
+    With ``dedupe_threshold`` set, a frame whose downscaled difference from
+    the last kept frame is below the threshold is dropped and the kept
+    frame's entry in ``durations`` (in source frames) grows instead.
+    """
+
+    _HEADER = re.compile(rb"P6\s+(\d+)\s+(\d+)\s+255\s")
+
+    def __init__(self, max_memory: int, dedupe_threshold=None):
+        self.max_memory = max_memory
+        self.dedupe_threshold = dedupe_threshold
+        self.width = self.height = None
+        self.frames = 0
+        self.durations = []
+        self.pending = bytearray()
+        self.memory = bytearray()
+        self.file = None
+        self.last_thumb = None
+
+    def feed(self, chunk: bytes):
+        self.pending += chunk
+        while True:
+            m = self._HEADER.match(self.pending)
+            if not m:
+                if len(self.pending) > 64 and not self.pending.startswith(b"P6"):
+                    raise RuntimeError("Unexpected data in ffmpeg frame stream")
+                return
+            w, h = int(m.group(1)), int(m.group(2))
+            frame_end = m.end() + w * h * 3
+            if len(self.pending) < frame_end:
+                return
+            if self.width is None:
+                self.width, self.height = w, h
+            elif (w, h) != (self.width, self.height):
+                raise RuntimeError("Frame size changed mid-stream")
+            frame = memoryview(self.pending)[m.end():frame_end]
+            if self._is_duplicate(frame):
+                self.durations[-1] += 1
+            else:
+                self._store(frame)
+                self.frames += 1
+                self.durations.append(1)
+            del frame
+            del self.pending[:frame_end]
+
+    def _is_duplicate(self, frame) -> bool:
+        if self.dedupe_threshold is None:
+            return False
+        import pyvips
+        image = pyvips.Image.new_from_memory(bytes(frame), self.width, self.height, 3, "uchar")
+        thumb = image.resize(64 / self.width).copy_memory()
+        if self.last_thumb is not None and (thumb - self.last_thumb).abs().avg() < self.dedupe_threshold:
+            return True
+        self.last_thumb = thumb
+        return False
+
+    def _store(self, data):
+        if self.file is None and len(self.memory) + len(data) > self.max_memory:
+            import tempfile
+            self.file = tempfile.NamedTemporaryFile(suffix=".rgb", delete=False)
+            self.file.write(self.memory)
+            self.memory = bytearray()
+        if self.file is not None:
+            self.file.write(data)
+        else:
+            self.memory += data
+
+    def to_image(self):
+        """The frame strip as a pyvips image (width × height·frames)."""
+        import pyvips
+        if self.file is not None:
+            self.file.flush()
+            strip = pyvips.Image.rawload(self.file.name, self.width,
+                                         self.height * self.frames, 3)
+        else:
+            strip = pyvips.Image.new_from_memory(self.memory, self.width,
+                                                 self.height * self.frames, 3, "uchar")
+        return strip.copy(interpretation="srgb")
+
+    def close(self):
+        self.memory = bytearray()
+        if self.file is not None:
+            self.file.close()
+            try: os.unlink(self.file.name)
+            except OSError: pass
+            self.file = None
+
+
+# ── Poster and preview ────────────────────────────────────────────────────────
+
+def byproduct_graph(label: str, vf_base: str, poster_path: str, preview_path: str) -> tuple:
+    """Filtergraph branch and output args for the poster and preview.
+
+    The branch reads stream ``[label]``, split off a decode that runs
+    anyway: the poster is the ``thumbnail`` pick of the first
+    POSTER_SCAN_FRAMES frames at output size, the preview a PREVIEW_FPS,
+    PREVIEW_WIDTH px GIF with its own small palette.
+    """
+    graph = (f"[{label}]split[bp][bv];"
+             f"[bp]{vf_base},thumbnail=n={POSTER_SCAN_FRAMES}[poster];"
+             f"[bv]fps={PREVIEW_FPS},scale={PREVIEW_WIDTH}:-2:flags=lanczos,split[va][vb];"
+             f"[va]palettegen=max_colors=64:stats_mode=diff[vp];[vb][vp]{PALETTEUSE}[preview]")
+    args = ["-map", "[poster]", "-frames:v", "1", "-q:v", "3", poster_path,
+            "-map", "[preview]", "-loop", "0", preview_path]
+    return graph, args
+
+
+# ── Palettes ──────────────────────────────────────────────────────────────────
+
+def generate_sampled_palette(src: str, seek: float, clip_duration: float, samples: int,
+                             scale: str, palette_path: str):
+    """Build a palette from ``samples`` evenly spaced frames of the clip.
+
+    Each sample is one input opened with a fast keyframe seek
+    (``-skip_frame nokey -noaccurate_seek``), so only a handful of
+    keyframes are decoded instead of the whole clip.
+    """
+    inputs, chains = [], []
+    for i in range(samples):
+        t = seek + clip_duration * (i + 0.5) / samples
+        inputs += ["-skip_frame", "nokey", "-noaccurate_seek", "-ss", f"{t:.3f}", "-i", src]
+        chains.append(f"[{i}:v]trim=end_frame=1,setpts=PTS-STARTPTS,{scale},setsar=1,format=rgb24[s{i}]")
+    graph = ";".join(chains) + ";" + "".join(f"[s{i}]" for i in range(samples)) + \
+        f"concat=n={samples}:v=1:a=0,palettegen=stats_mode=full"
+    r = run_ffmpeg(["ffmpeg", "-y", *inputs, "-filter_complex", graph, palette_path], timeout=120)
+    if r.returncode != 0:
+        raise RuntimeError(f"Palette generation failed:\n{r.stderr[-800:]}")
+
+
+def read_palette(palette_path: str) -> list:
+    """The colors of a palettegen PNG as a list of (r, g, b)."""
+    r = subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", palette_path, "-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:1"],
+        capture_output=True, timeout=30
+    )
+    if r.returncode != 0:
+        raise RuntimeError("Could not read palette")
+    data = r.stdout
+    return sorted({tuple(data[i:i + 3]) for i in range(0, len(data) - 2, 3)})
+
+
+def _srgb_to_lab(rgb) -> tuple:
+    def linear(c):
+        c /= 255
+        return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+    r, g, b = (linear(float(c)) for c in rgb)
+    x = (0.4124 * r + 0.3576 * g + 0.1805 * b) / 0.95047
+    y = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    z = (0.0193 * r + 0.1192 * g + 0.9505 * b) / 1.08883
+
+    def f(t):
+        return t ** (1 / 3) if t > 0.008856 else 7.787 * t + 16 / 116
+    fx, fy, fz = f(x), f(y), f(z)
+    return 116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz)
+
+
+def palette_delta_e(reference: list, candidate: list) -> dict:
+    """How well ``candidate`` covers ``reference``: CIE76 ΔE from each
+    reference color to its nearest candidate color (mean and max)."""
+    ref_lab = [_srgb_to_lab(c) for c in reference]
+    cand_lab = [_srgb_to_lab(c) for c in candidate]
+    distances = [
+        min(((l1 - l2) ** 2 + (a1 - a2) ** 2 + (b1 - b2) ** 2) ** 0.5 for l2, a2, b2 in cand_lab)
+        for l1, a1, b1 in ref_lab
+    ]
+    return {"mean_delta_e": round(sum(distances) / len(distances), 2),
+            "max_delta_e": round(max(distances), 2)}
+
+
+# ── GIF container ─────────────────────────────────────────────────────────────
+
+def _skip_sub_blocks(data: bytes, pos: int) -> int:
+    while True:
+        n = data[pos]
+        pos += 1 + n
+        if n == 0:
+            return pos
+
+
+def _walk_gif(data) -> tuple:
+    """Locate the global color table and every block of a GIF.
+
+    Returns ``(palette_end, blocks)`` with ``blocks`` a list of
+    ``(kind, start, end)`` offsets into ``data`` (bytes or mmap), ``kind``
+    being "image", "gce" (graphic control), "app" or "ext". Image data is
+    skipped over sub-block by sub-block, never LZW-decoded.
+    """
+    if data[:6] not in (b"GIF87a", b"GIF89a"):
+        raise ValueError("Not a GIF file")
+    try:
+        packed = data[10]
+        pos = 13
+        if packed & 0x80:
+            pos += 3 * (2 << (packed & 7))
+        palette_end = pos
+        blocks = []
+        while pos < len(data) and data[pos] != 0x3B:  # tolerate a missing trailer
+            start = pos
+            if data[pos] == 0x21:
+                kind = {0xF9: "gce", 0xFF: "app"}.get(data[pos + 1], "ext")
+                pos = _skip_sub_blocks(data, pos + 2)
+            elif data[pos] == 0x2C:
+                packed = data[pos + 9]
+                pos += 10
+                if packed & 0x80:
+                    pos += 3 * (2 << (packed & 7))
+                kind = "image"
+                pos = _skip_sub_blocks(data, pos + 1)  # after the LZW code size
+            else:
+                raise ValueError(f"Corrupt GIF: unknown block 0x{data[pos]:02x} at {pos}")
+            blocks.append((kind, start, pos))
+    except IndexError:
+        raise ValueError("Corrupt GIF: truncated")
+    return palette_end, blocks
+
+
+def parse_gif(data: bytes) -> dict:
+    """Split a GIF into its screen descriptor, global color table and
+    ``(kind, raw)`` blocks (see _walk_gif)."""
+    palette_end, blocks = _walk_gif(data)
+    return {"screen": data[6:13], "palette": data[13:palette_end],
+            "blocks": [(kind, data[start:end]) for kind, start, end in blocks]}
+
+
+def gif_info(path: str) -> dict:
+    """Size, frame count, total duration (s) and loop count of a GIF file.
+
+    Reads only the block structure through an mmap, so it costs next to
+    nothing even for large outputs. ``loop`` is None when the file has no
+    NETSCAPE2.0 extension (plays once) and 0 for forever.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        _, blocks = _walk_gif(data)
+        frames, centiseconds, loop = 0, 0, None
+        for kind, start, end in blocks:
+            if kind == "image":
+                frames += 1
+            elif kind == "gce" and end - start >= 8:
+                centiseconds += int.from_bytes(data[start + 4:start + 6], "little")
+            elif kind == "app" and data[start + 3:start + 14] == b"NETSCAPE2.0" and end - start >= 19:
+                loop = int.from_bytes(data[start + 16:start + 18], "little")
+        return {
+            "width": int.from_bytes(data[6:8], "little"),
+            "height": int.from_bytes(data[8:10], "little"),
+            "frames": frames,
+            "duration": centiseconds / 100,
+            "loop": loop,
+        }
+
+
+def netscape_loop(loop: int) -> bytes:
+    """NETSCAPE2.0 extension: 0 repeats forever, N repeats N more times."""
+    return b"\x21\xff\x0bNETSCAPE2.0\x03\x01" + loop.to_bytes(2, "little") + b"\x00"
+
+
+def concat_gifs(paths: list, output_path: str, loop: int):
+    """Join same-sized GIFs into one animation.
+
+    Frames and their delays are copied as-is. Loop extensions are dropped
+    in favour of one for ``loop`` (-1: play once, as with ffmpeg), and a part
+    whose global palette differs from the first part's gets it as a local
+    palette on each of its frames.
+    """
+    first = None
+    with open(output_path, "wb") as out:
+        for path in paths:
+            gif = parse_gif(Path(path).read_bytes())
+            if first is None:
+                first = gif
+                out.write(b"GIF89a" + gif["screen"] + gif["palette"])
+                if loop >= 0:
+                    out.write(netscape_loop(loop))
+            elif gif["screen"][:4] != first["screen"][:4]:
+                raise ValueError("GIF parts differ in size")
+            local = gif["palette"] if gif["palette"] != first["palette"] else b""
+            size_bits = gif["screen"][4] & 7
+            for kind, raw in gif["blocks"]:
+                if kind == "app":
+                    continue
+                if kind == "image" and local and not raw[9] & 0x80:
+                    raw = raw[:9] + bytes([(raw[9] & 0x78) | 0x80 | size_bits]) + local + raw[10:]
+                out.write(raw)
+        out.write(b"\x3b")
+
+
+# ── WebP, APNG and MP4 ────────────────────────────────────────────────────────
+
+def _plays(loop: int) -> int:
+    """GIF-style loop (-1 once, 0 forever, N repeats) → WebP/APNG play count."""
+    return 0 if loop == 0 else max(1, loop + 1)
+
+
+def format_args(fmt: str, loop: int) -> list:
+    """ffmpeg encoder and muxer options for a non-GIF output format."""
+    if fmt == "webp":
+        return ["-c:v", "libwebp_anim", "-quality", str(WEBP_QUALITY), "-compression_level", "4",
+                "-loop", str(_plays(loop)), "-f", "webp"]
+    if fmt == "apng":
+        return ["-c:v", "apng", "-plays", str(_plays(loop)), "-f", "apng"]
+    # MP4 has no loop flag; players loop it (the UI's <video loop>)
+    return ["-c:v", "libx264", "-preset", "veryfast", "-crf", str(MP4_CRF),
+            "-pix_fmt", "yuv420p", "-movflags", "+faststart", "-f", "mp4"]
+
+
+def webp_info(path: str) -> dict:
+    """Size, frame count and total duration (s) of a WebP file, read from
+    its RIFF chunks like gif_info. (ffmpeg can't decode animated WebP.)"""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:4] != b"RIFF" or data[8:12] != b"WEBP":
+            raise ValueError("Not a WebP file")
+        width = height = frames = ms = 0
+        pos = 12
+        while pos + 8 <= len(data):
+            fourcc, size, body = data[pos:pos + 4], int.from_bytes(data[pos + 4:pos + 8], "little"), pos + 8
+            if fourcc == b"VP8X":
+                width = int.from_bytes(data[body + 4:body + 7], "little") + 1
+                height = int.from_bytes(data[body + 7:body + 10], "little") + 1
+            elif fourcc == b"ANMF":
+                frames += 1
+                ms += int.from_bytes(data[body + 12:body + 15], "little")
+            elif fourcc == b"VP8L" and not width:  # still, lossless
+                bits = int.from_bytes(data[body + 1:body + 5], "little")
+                width, height, frames = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, 1
+            elif fourcc == b"VP8 " and not width:  # still, lossy
+                width = int.from_bytes(data[body + 6:body + 8], "little") & 0x3FFF
+                height = int.from_bytes(data[body + 8:body + 10], "little") & 0x3FFF
+                frames = 1
+            pos = body + size + (size & 1)
+        return {"width": width, "height": height, "frames": max(frames, 1), "duration": ms / 1000}
+
+
+def apng_info(path: str) -> dict:
+    """Size, frame count and total duration (s) of an APNG file, summed from
+    its fcTL frame delays like webp_info. (ffprobe reports no duration.)"""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:8] != b"\x89PNG\r\n\x1a\n":
+            raise ValueError("Not a PNG file")
+        width = height = frames = 0
+        seconds = 0.0
+        pos = 8
+        while pos + 8 <= len(data):
+            size, kind, body = int.from_bytes(data[pos:pos + 4], "big"), data[pos + 4:pos + 8], pos + 8
+            if kind == b"IHDR":
+                width = int.from_bytes(data[body:body + 4], "big")
+                height = int.from_bytes(data[body + 4:body + 8], "big")
+            elif kind == b"fcTL":
+                frames += 1
+                delay_num = int.from_bytes(data[body + 20:body + 22], "big")
+                delay_den = int.from_bytes(data[body + 22:body + 24], "big") or 100  # 0 means 1/100 s
+                seconds += delay_num / delay_den
+            elif kind == b"IEND":
+                break
+            pos = body + size + 4  # data + CRC
+        return {"width": width, "height": height, "frames": max(frames, 1),
+                "duration": round(seconds, 2)}
+
+
+def output_info(path: str) -> dict:
+    """gif_info for any output format: width, height, frames, duration."""
+    if path.endswith(".gif"):
+        return gif_info(path)
+    if path.endswith(".webp"):
+        return webp_info(path)
+    if path.endswith(".apng"):
+        return apng_info(path)
+    r = subprocess.run(
+        ["ffprobe", "-v", "quiet", "-select_streams", "v:0", "-count_packets",
+         "-show_entries", "stream=width,height,nb_read_packets:format=duration", "-of", "json", path],
+        capture_output=True, text=True, timeout=60
+    )
+    try:
+        data = json.loads(r.stdout or "{}")
+        stream = data["streams"][0]
+        return {
+            "width": int(stream["width"]),
+            "height": int(stream["height"]),
+            "frames": int(stream.get("nb_read_packets", 0)),
+            "duration": round(float(data.get("format", {}).get("duration") or 0), 2),
+        }
+    except (ValueError, KeyError, IndexError, TypeError):
+        raise RuntimeError(f"Could not read the output file:\n{r.stderr[-800:]}")
+
+
+# ── Segment-parallel rendering ────────────────────────────────────────────────
+
+def render_segments(src: str, palette_path: str, seek: float, clip_duration: float,
+                    count: int, vf_base: str, dedupe: bool, fps: int, prefix: str,
+                    on_progress=None) -> list:
+    """Render the clip as ``count`` GIFs in parallel, one per time segment.
+
+    Cuts fall on the output frame grid and every segment maps the same
+    palette, so concat_gifs can join the parts without a visible seam.
+    Returns the part paths in order; the caller deletes them.
+    """
+    frames = max(count, round(clip_duration * fps))
+    bounds = [round(frames * i / count) for i in range(count + 1)]
+    paths = [str(OUTPUT_DIR / f"{prefix}{i}.gif") for i in range(count)]
+    vfr_args = ["-fps_mode", "vfr"] if dedupe else []
+    done = [0.0] * count
+    lock = threading.Lock()
+
+    def render(i):
+        offset = bounds[i] / fps
+        length = (bounds[i + 1] - bounds[i]) / fps if i < count - 1 else clip_duration - offset
+        # Each part keeps its own static tail (see dedupe_filter)
+        vf = f"{vf_base},{dedupe_filter(fps, length)}" if dedupe else vf_base
+
+        def progress(p):
+            if on_progress and p["out_time"] is not None:
+                with lock:
+                    done[i] = min(p["out_time"], length)
+                    on_progress({"out_time": sum(done), "frame": None, "speed": None})
+
+        r = run_ffmpeg(
+            ["ffmpeg", "-y", "-ss", f"{seek + offset:.6f}", "-t", f"{length:.6f}",
+             "-i", src, "-i", palette_path,
+             "-lavfi", f"{vf} [x]; [x][1:v] {PALETTEUSE}",
+             *vfr_args, *output_limit_args(), "-loop", "-1", paths[i]],
+            timeout=300, on_progress=progress
+        )
+        if r.returncode != 0:
+            raise RuntimeError(f"GIF conversion failed (segment {i + 1}/{count}):\n{r.stderr[-800:]}")
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(count) as pool:
+            # copy_context: each part's ffmpeg usage is still logged to the job
+            for future in [pool.submit(contextvars.copy_context().run, render, i)
+                           for i in range(count)]:
+                future.result()
+    except BaseException:
+        for path in paths:
+            try: os.unlink(path)
+            except OSError: pass
+        raise
+    return paths
+
+
+# ── Size targeting (max_bytes) ────────────────────────────────────────────────
+
+FIT_COLORS = {256: 1.0, 128: 0.85, 64: 0.7}             # rough size factor per palette size
+FIT_DITHER = {"bayer:bayer_scale=5": 1.0, "none": 0.8}
+
+
+def _fit_ladder(fps: int) -> list:
+    """Candidate settings, best quality (largest predicted size) first.
+
+    ``scale`` is relative to the already-scaled work file; ``factor`` is
+    the predicted size relative to the first candidate.
+    """
+    # Lower rates bottom out at 5 fps, but never exceed the requested rate
+    rates = sorted({fps, *(min(fps, max(5, round(fps * f))) for f in (0.75, 0.5))}, reverse=True)
+    ladder = []
+    for scale in (1.0, 0.85, 0.7, 0.55, 0.4):
+        for rate in rates:
+            for colors, color_factor in FIT_COLORS.items():
+                for dither, dither_factor in FIT_DITHER.items():
+                    ladder.append({
+                        "scale": scale, "fps": rate, "colors": colors, "dither": dither,
+                        "factor": scale * scale * (rate / fps) * color_factor * dither_factor,
+                    })
+    ladder.sort(key=lambda c: -c["factor"])
+    return ladder
+
+
+def _encode_candidate(src: str, candidate: dict, output_path: str, loop: int,
+                      time_args=(), on_progress=None, dedupe=False, duration=None):
+    """Two-pass palette encode of the work file with one candidate's settings.
+
+    ``duration`` is the length being encoded, for dedupe_filter."""
+    scale = ""
+    if candidate["scale"] != 1.0:
+        scale = f",scale=trunc(iw*{candidate['scale']}/2)*2:-2:flags=lanczos"
+    vf = f"fps={candidate['fps']}{scale}"
+    if dedupe:
+        vf += "," + dedupe_filter(candidate["fps"], duration)
+    vfr_args = ["-fps_mode", "vfr"] if dedupe else []
+    palette_path = output_path + ".palette.png"
+    try:
+        r = run_ffmpeg(
+            ["ffmpeg", "-y", *time_args, "-i", src,
+             "-vf", f"{vf},palettegen=max_colors={candidate['colors']}:stats_mode=diff", palette_path],
+            timeout=120, on_progress=on_progress
+        )
+        if r.returncode != 0:
+            raise RuntimeError(f"Palette generation failed:\n{r.stderr[-800:]}")
+        r = run_ffmpeg(
+            ["ffmpeg", "-y", *time_args, "-i", src, "-i", palette_path,
+             "-lavfi", f"{vf} [x]; [x][1:v] paletteuse=dither={candidate['dither']}:diff_mode=rectangle",
+             *vfr_args, "-loop", str(loop), output_path],
+            timeout=300, on_progress=on_progress
+        )
+        if r.returncode != 0:
+            raise RuntimeError(f"GIF conversion failed:\n{r.stderr[-800:]}")
+    finally:
+        try: os.unlink(palette_path)
+        except OSError: pass
+    return os.path.getsize(output_path)
+
+
+def fit_to_size(work_path: str, clip_duration, fps: int, loop: int, max_bytes: int,
+                output_path: str, update, dedupe=False) -> dict:
+    """Render the best-quality GIF of ``work_path`` that is under ``max_bytes``.
+
+    ``work_path`` is the clip already trimmed, decoded once and scaled to
+    the requested width (lossless FFV1), so every trial only re-encodes.
+    Each candidate's full size is estimated from a short sample encode; a
+    size model (∝ width² · fps · palette/dither factors) calibrated by
+    those samples skips candidates that cannot fit. The chosen candidate
+    is then encoded in full, stepping further down the ladder if the real
+    GIF still overshoots.
+    """
+    budget = max_bytes * 0.95  # headroom for estimate error
+    ladder = _fit_ladder(fps)
+    sample = FIT_SAMPLE_SECONDS
+    sample_args = []
+    if clip_duration and clip_duration > sample * 2:
+        sample_args = ["-ss", f"{(clip_duration - sample) / 2:.3f}", "-t", f"{sample:.3f}"]
+        scale_up = clip_duration / sample
+    else:
+        sample = clip_duration
+        scale_up = 1.0  # short clip: the "sample" is the whole thing
+    sample_path = output_path + ".sample.gif"
+
+    calibration = None  # estimated bytes for factor 1.0
+    full_encodes = 0
+    i = 0
+    try:
+        while i < len(ladder):
+            candidate = ladder[i]
+            if calibration and candidate["factor"] * calibration > budget:
+                i += 1
+                continue
+            label = (f"{int(candidate['scale'] * 100)}% width, {candidate['fps']} fps, "
+                     f"{candidate['colors']} colors")
+            update(f"Estimating size ({label})…")
+            estimate = _encode_candidate(work_path, candidate, sample_path, loop, sample_args,
+                                         dedupe=dedupe, duration=sample) * scale_up
+            calibration = estimate / candidate["factor"]
+            if estimate > budget:
+                i += 1
+                continue
+
+            full_encodes += 1
+            update(f"Rendering GIF ({label})…")
+            size = _encode_candidate(work_path, candidate, output_path, loop, dedupe=dedupe,
+                                     duration=clip_duration)
+            if size <= max_bytes:
+                return {**candidate, "bytes": size, "attempts": full_encodes}
+            if full_encodes >= FIT_MAX_FULL_ENCODES:
+                break
+            calibration = size / candidate["factor"]
+            i += 1
+    finally:
+        try: os.unlink(sample_path)
+        except OSError: pass
+    raise RuntimeError(f"Couldn't fit the GIF under {max_bytes / 1024 / 1024:.1f} MB. "
+                       "Try a shorter clip.")
+
+
+# ── Worker pool ───────────────────────────────────────────────────────────────
+
+def queue_full() -> bool:
+    return job_store.queue_length() >= MAX_QUEUED_JOBS
+
+
+def enqueue_job(job_id: str, params: dict) -> bool:
+    """Append a job to the FIFO. Returns False if the queue is full."""
+    params["queued_at"] = time.time()  # wall clock: may be claimed by another process
+    if not job_store.enqueue(job_id, {"status": "queued", "step": "Queued…"},
+                             params, MAX_QUEUED_JOBS):
+        return False
+    with job_queue_cond:
+        job_queue_cond.notify()
+    return True
+
+
+def queue_position(job_id: str) -> int:
+    """1-based position of a waiting job, or 0 if it is not queued."""
+    return job_store.queue_position(job_id)
+
+
+def _worker_loop():
+    """Worker thread: claim jobs off the FIFO and convert them one at a time."""
+    while True:
+        claimed = None
+        owner = claim_owner()
+        job_owner.set(owner)
+        try:
+            claimed = job_store.claim(owner)
+            if claimed is None:
+                with job_queue_cond:
+                    # Other processes can enqueue into a shared store without
+                    # notifying us, so re-check it periodically.
+                    job_queue_cond.wait(JOB_STORE_POLL_SECONDS if job_store.shared else None)
+                continue
+            notify_job(None)  # queued jobs' positions moved
+            run_conversion(*claimed)
+        except sqlite3.Error as e:
+            # Lock contention outlasted the busy timeout; back off and keep
+            # this worker. A job whose final update was lost would stay
+            # "running" under our heartbeat forever, so retry marking it.
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+            if claimed is not None:
+                try:
+                    if (job_store.get(claimed[0]) or {}).get("status") == "running":
+                        set_job(claimed[0], {"status": "error", "error": f"Job store unavailable: {e}"},
+                                owner)
+                except sqlite3.Error:
+                    pass
+
+
+def _heartbeat_loop():
+    """Keep this process's running jobs alive, requeue jobs whose owner
+    died and flush this process's metrics."""
+    while True:
+        metrics.flush()
+        try:
+            job_store.heartbeat(process_owner())
+            if job_store.requeue_stale(JOB_STALE_SECONDS):
+                with job_queue_cond:
+                    job_queue_cond.notify_all()
+        except sqlite3.Error:
+            pass  # transient lock contention; try again next beat
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+
+
+def start_workers():
+    for _ in range(max(1, MAX_CONCURRENT_JOBS)):
+        threading.Thread(target=_worker_loop, daemon=True).start()
+    if job_store.shared:
+        threading.Thread(target=_heartbeat_loop, daemon=True).start()
+
+
+# ── Worker processes (--workers N) ────────────────────────────────────────────
+
+def worker_process_main(parent_pid: int):
+    """Entry point of a --workers child: convert jobs claimed from the shared
+    store, one at a time, until the HTTP process goes away."""
+    def watch_parent():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(1)  # orphaned; our running job will be requeued as stale
+
+    threading.Thread(target=watch_parent, daemon=True).start()
+    threading.Thread(target=_heartbeat_loop, daemon=True).start()
+    try:
+        _worker_loop()
+    except KeyboardInterrupt:
+        pass
+
+
+def _supervise_workers(count: int):
+    """Keep ``count`` worker processes alive; requeue a dead worker's job."""
+    ctx = multiprocessing.get_context("spawn")  # no inherited threads or SQLite handles
+    procs = {}
+
+    def spawn(slot):
+        proc = ctx.Process(target=worker_process_main, args=(os.getpid(),),
+                           name=f"gif-worker-{slot}", daemon=True)
+        proc.start()
+        procs[slot] = proc
+
+    for slot in range(count):
+        spawn(slot)
+    while True:
+        time.sleep(1)
+        for slot, proc in list(procs.items()):
+            if not proc.is_alive():
+                try:
+                    job_store.requeue_owner(f"{socket.gethostname()}:{proc.pid}:")
+                except sqlite3.Error:
+                    pass  # the heartbeat sweep will catch it
+                spawn(slot)
+
+
+def start_worker_processes(count: int):
+    threading.Thread(target=_supervise_workers, args=(count,), daemon=True).start()
+    threading.Thread(target=_heartbeat_loop, daemon=True).start()  # stale-job sweep
+
+
+def format_size(nbytes: int) -> str:
+    return f"{nbytes/1024:.0f} KB" if nbytes < 1024*1024 else f"{nbytes/1024/1024:.1f} MB"
+
+
+def run_conversion(job_id: str, params: dict):
+    if params.get("variants"):
+        return run_batch_conversion(job_id, params)
+    owner = job_owner.get()  # captured: progress also arrives on ffmpeg's reader threads
 
     def update(step, **extra):
-        jobs[job_id] = {"status": "running", "step": step, **extra}
+        set_job(job_id, {"status": "running", "step": step, **extra}, owner)
+
+    def tracker(step, lo, hi):
+        """Map one ffmpeg run's out_time onto the [lo, hi] share of the job."""
+        update(step, progress=lo if clip_duration else None)
+
+        def on_progress(p):
+            progress = eta = None
+            if clip_duration and p["out_time"] is not None:
+                progress = round(lo + (hi - lo) * min(1.0, p["out_time"] / clip_duration), 3)
+                if progress >= 0.05:
+                    elapsed = time.monotonic() - started
+                    eta = round(elapsed * (1 - progress) / progress)
+            update(step, progress=progress, eta=eta, frame=p["frame"], speed=p["speed"])
+        return on_progress
+
+    clip_duration = None
+    started = time.monotonic()
 
     input_path = None
+    trimmed_path = None
+    work_path = None
     palette_path = None
-    frames_dir = None
+    spool = None
+    stages = StageTimer()
+    usage = []
+    job_usage.set(usage)
+    output_path = poster_path = preview_path = None
+    encoder = params.get("encoder", "?")
+    if params.get("queued_at"):
+        metrics.observe("gifmaker_queue_wait_seconds", max(0.0, time.time() - params["queued_at"]))
     try:
         update("Saving uploaded video…")
 
@@ -789,21 +3632,46 @@ def run_conversion(job_id: str, params: dict):
         if not video_data or not isinstance(video_data, dict):
             raise ValueError("No video file received")
 
-        suffix = Path(video_data["filename"]).suffix or ".mp4"
-        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
-            f.write(video_data["data"])
-            input_path = f.name
+        # parse_multipart already spooled the upload to a temp file
+        input_path = video_data["path"]
+        if not video_data["size"]:
+            raise ValueError("Uploaded video is empty")
 
         # Options
-        fps       = int(params.get("fps", "15"))
-        width_opt = params.get("width", "640")
-        start     = params.get("start", "").strip()
-        end       = params.get("end", "").strip()
-        encoder   = params.get("encoder", "ffmpeg-high")
-        loop      = int(params.get("loop", "0"))
-
-        output_name = f"{job_id}.gif"
+        opts         = conversion_options(params)
+        fps          = opts["fps"]
+        width_opt    = opts["width"]
+        start        = opts["start"]
+        end          = opts["end"]
+        encoder      = opts["encoder"]
+        fmt          = opts["format"]
+        loop         = opts["loop"]
+        palette_mode = opts["palette_mode"]
+        samples      = opts["palette_samples"]
+        max_bytes    = opts["max_bytes"]
+        dedupe       = opts["dedupe"]
+        fit = None
+
+        # Validate start/end against the input and pre-trim the window.
+        # Clip length also drives progress: out_time / clip_duration.
+        if start is not None or end is not None:
+            update("Trimming clip…")
+        media = video_data.get("media") or probe_media(input_path, video_data.get("sha256"))
+        stages.start("trim")
+        clip = prepare_clip(input_path, start, end, media)
+        stages.stop()
+        source_path = clip["path"]
+        trimmed_path = clip["trimmed"]
+        time_args = clip["time_args"]
+        clip_duration = clip["duration"]
+        palette_info = None
+        segment_count = None
+
+        output_name = f"{job_id}{FORMATS[fmt]}"
         output_path = str(OUTPUT_DIR / output_name)
+        if opts["previews"]:
+            poster_path = str(OUTPUT_DIR / f"{job_id}_poster.jpg")
+            preview_path = str(OUTPUT_DIR / f"{job_id}_preview.gif")
 
         # ffmpeg scale filter
         if width_opt == "original":
@@ -811,126 +3679,412 @@ def run_conversion(job_id: str, params: dict):
         else:
             scale = f"scale={width_opt}:-2:flags=lanczos"
         vf_base = f"fps={fps},{scale}"
-
-        # ffmpeg time-range args
-        time_args = []
-        if start:
-            time_args += ["-ss", start]
-        if end:
-            if start:
-                time_args += ["-t", str(float(end) - float(start))]
-            else:
-                time_args += ["-to", end]
+        # dedupe: mpdecimate drops near-duplicate frames and -fps_mode vfr
+        # keeps the gaps, which the GIF muxer turns into longer frame delays
+        vf_gif = f"{vf_base},{dedupe_filter(fps, clip_duration)}" if dedupe else vf_base
+        vfr_args = ["-fps_mode", "vfr"] if dedupe else []
+
+        # Main chains read [vin] and write [vout]; with previews on, the
+        # decoded input is split and the by-products ride along.
+        byproducts = byproduct_graph("bx", vf_base, poster_path, preview_path) if opts["previews"] else None
+
+        def filter_args(main):
+            if not byproducts:
+                return ["-filter_complex", main.replace("[vin]", "[0:v]", 1), "-map", "[vout]"]
+            return ["-filter_complex", f"[0:v]split[vin][bx];{main};{byproducts[0]}", "-map", "[vout]"]
+
+        extra_outputs = byproducts[1] if byproducts else []
+        extra_files = [poster_path, preview_path] if byproducts else []
+
+        # ── Size target (max_bytes) ───────────────────────────────────────────
+        # Decode + scale once into a lossless work file, then search
+        # fps / width / palette / dither for the best GIF under the budget.
+        if max_bytes:
+            stages.start("fit")
+            import tempfile
+            fd, work_path = tempfile.mkstemp(suffix=".mkv")
+            os.close(fd)
+            r = run_ffmpeg(
+                ["ffmpeg", "-y", *time_args, "-i", source_path,
+                 *filter_args(f"[vin]{vf_base}[vout]"), "-c:v", "ffv1", work_path, *extra_outputs],
+                timeout=300, outputs=[work_path, *extra_files],
+                on_progress=tracker("Decoding clip…", 0.0, 0.3)
+            )
+            if r.returncode != 0:
+                raise RuntimeError(f"Decoding failed:\n{r.stderr[-800:]}")
+            fit = fit_to_size(work_path, clip_duration, fps, loop, max_bytes, output_path, update,
+                              dedupe=dedupe)
+            fps = fit["fps"]
 
         # ── libvips ───────────────────────────────────────────────────────────
-        if encoder == "libvips":
-            import glob as globmod
-            frames_dir = tempfile.mkdtemp()
-            update("Extracting frames…")
-            frame_pattern = os.path.join(frames_dir, "frame%05d.png")
+        elif encoder == "libvips":
+            # Frames come straight off ffmpeg's stdout as uncompressed PPM —
+            # no per-frame PNG encode/decode and no frames directory.
+            stages.start("extract")
+            spool = FrameSpool(LIBVIPS_SPOOL_MEMORY_BYTES,
+                               dedupe_threshold=DEDUPE_THRESHOLD if dedupe else None)
             extract_cmd = [
                 "ffmpeg", "-y", *time_args,
-                "-i", input_path,
-                "-vf", vf_base,
-                frame_pattern
+                "-i", source_path,
+                *filter_args(f"[vin]{vf_base}[vout]"),
+                "-pix_fmt", "rgb24", "-f", "image2pipe", "-c:v", "ppm", "pipe:1",
+                *extra_outputs
             ]
-            r = subprocess.run(extract_cmd, capture_output=True, text=True, timeout=180)
+            r = run_ffmpeg(extract_cmd, timeout=180, stdout_sink=spool.feed,
+                           outputs=["pipe:1", *extra_files], on_progress=tracker("Extracting frames…", 0.0, 0.6))
             if r.returncode != 0:
                 raise RuntimeError(f"Frame extraction failed:\n{r.stderr[-800:]}")
 
-            frames = sorted(globmod.glob(os.path.join(frames_dir, "frame*.png")))
-            if not frames:
+            if not spool.frames:
                 raise RuntimeError("No frames extracted from video")
 
-            update(f"Encoding {len(frames)} frames with libvips…")
+            stages.start("render")
+            update(f"Encoding {spool.frames} frames with libvips…",
+                   progress=0.6 if clip_duration else None, frame=spool.frames)
 
             # Use pyvips to set page-height + delay metadata correctly.
             # The vips CLI arrayjoin → gifsave path fails when total stacked
             # height (frame_h × N) exceeds the GIF canvas limit of 65535px.
             # pyvips lets us set these fields explicitly before saving.
             import pyvips
-            images = [pyvips.Image.new_from_file(f, access="sequential") for f in frames]
-            joined = pyvips.Image.arrayjoin(images, across=1)
-            delay_ms = max(10, round(1000 / fps))
-            joined.set_type(pyvips.GValue.array_int_type, "delay", [delay_ms] * len(images))
-            joined.set_type(pyvips.GValue.gint_type, "page-height", images[0].height)
-            joined.set_type(pyvips.GValue.gint_type, "loop", loop)
-            joined.gifsave(output_path, effort=7, dither=1.0)
-
-        # ── ffmpeg high (2-pass palette) ──────────────────────────────────────
-        elif encoder == "ffmpeg-high":
-            update("Generating color palette…")
-            palette_path = str(OUTPUT_DIR / f"{job_id}_palette.png")
-            r = subprocess.run(
-                ["ffmpeg", "-y", *time_args, "-i", input_path,
-                 "-vf", f"{vf_base},palettegen=stats_mode=diff", palette_path],
-                capture_output=True, text=True, timeout=120
+            joined = spool.to_image()
+            # Merged duplicates hold their frame for several source frames
+            delays = [max(10, round(1000 * n / fps)) for n in spool.durations]
+            joined.set_type(pyvips.GValue.array_int_type, "delay", delays)
+            joined.set_type(pyvips.GValue.gint_type, "page-height", spool.height)
+            if fmt == "webp":
+                joined.set_type(pyvips.GValue.gint_type, "loop", _plays(loop))
+                joined.webpsave(output_path, Q=WEBP_QUALITY, effort=4)
+            else:
+                joined.set_type(pyvips.GValue.gint_type, "loop", loop)
+                joined.gifsave(output_path, effort=7, dither=1.0)
+
+        # ── ffmpeg WebP / APNG / MP4 ──────────────────────────────────────────
+        # Same trimmed, scaled (and deduped) frame stream as the GIF paths,
+        # handed straight to the format's encoder — no palette pass.
+        elif fmt != "gif":
+            stages.start("render")
+            vf = vf_gif
+            if fmt == "webp":
+                # libwebp_anim merges unchanged frames itself and times them
+                # right; after mpdecimate it stretches the last frame
+                vf, vfr_args = vf_base, []
+            if fmt == "mp4":
+                vf += ",scale=trunc(iw/2)*2:trunc(ih/2)*2"  # yuv420p needs even sides
+            result = run_ffmpeg(
+                ["ffmpeg", "-y", *time_args, "-i", source_path, *filter_args(f"[vin]{vf}[vout]"),
+                 *vfr_args, *format_args(fmt, loop), *output_limit_args(), output_path, *extra_outputs],
+                timeout=300, outputs=[output_path, *extra_files],
+                on_progress=tracker(f"Rendering {fmt.upper()}…", 0.0, 1.0)
             )
-            if r.returncode != 0:
-                raise RuntimeError(f"Palette generation failed:\n{r.stderr[-800:]}")
-
-            update("Rendering GIF…")
-            result = subprocess.run(
-                ["ffmpeg", "-y", *time_args, "-i", input_path, "-i", palette_path,
-                 "-lavfi", f"{vf_base} [x]; [x][1:v] paletteuse=dither=bayer:bayer_scale=5:diff_mode=rectangle",
-                 "-loop", str(loop), output_path],
-                capture_output=True, text=True, timeout=300
+            if result.returncode != 0:
+                raise RuntimeError(f"{fmt.upper()} conversion failed:\n{result.stderr[-800:]}")
+
+        # ── ffmpeg high, single pass (split → palettegen → paletteuse) ────────
+        # Decodes and scales the clip once. paletteuse has to hold every
+        # frame until palettegen has seen the whole stream, so this trades
+        # memory for the second decode.
+        elif encoder == "ffmpeg-high" and palette_mode == "single-pass":
+            stages.start("render")
+            result = run_ffmpeg(
+                ["ffmpeg", "-y", *time_args, "-i", source_path,
+                 *filter_args(f"[vin]{vf_gif},split[a][b];[a]palettegen=stats_mode=diff[p];"
+                              f"[b][p]{PALETTEUSE}[vout]"),
+                 *vfr_args, *output_limit_args(), "-loop", str(loop), output_path, *extra_outputs],
+                timeout=300, outputs=[output_path, *extra_files],
+                on_progress=tracker("Rendering GIF…", 0.0, 1.0)
             )
             if result.returncode != 0:
                 raise RuntimeError(f"GIF conversion failed:\n{result.stderr[-800:]}")
 
+        # ── ffmpeg high (2-pass palette) ──────────────────────────────────────
+        elif encoder == "ffmpeg-high":
+            palette_path = str(OUTPUT_DIR / f"{job_id}_palette.png")
+
+            def full_scan_palette(path, on_progress=None):
+                r = run_ffmpeg(
+                    ["ffmpeg", "-y", *time_args, "-i", source_path,
+                     "-vf", f"{vf_gif},palettegen=stats_mode=diff", path],
+                    timeout=120, on_progress=on_progress
+                )
+                if r.returncode != 0:
+                    raise RuntimeError(f"Palette generation failed:\n{r.stderr[-800:]}")
+
+            stages.start("palette")
+            # Sampling only pays off once the clip has more frames than samples
+            if palette_mode == "sampled" and clip_duration and clip_duration * fps > samples:
+                update(f"Generating color palette from {samples} frames…",
+                       progress=0.0 if clip_duration else None)
+                t0 = time.monotonic()
+                generate_sampled_palette(source_path, clip["seek"], clip_duration, samples,
+                                         scale, palette_path)
+                palette_info = {"samples": samples, "seconds": round(time.monotonic() - t0, 2)}
+                if opts["palette_metrics"]:
+                    # Reference full-scan palette, for choosing PALETTE_SAMPLES
+                    update("Measuring palette quality…")
+                    reference_path = palette_path + ".full.png"
+                    try:
+                        t0 = time.monotonic()
+                        full_scan_palette(reference_path)
+                        palette_info["full_scan_seconds"] = round(time.monotonic() - t0, 2)
+                        palette_info.update(palette_delta_e(read_palette(reference_path),
+                                                            read_palette(palette_path)))
+                    finally:
+                        try: os.unlink(reference_path)
+                        except OSError: pass
+            else:
+                full_scan_palette(palette_path, tracker("Generating color palette…", 0.0, 0.4))
+
+            stages.start("render")
+            if clip_duration:
+                segment_count = min(opts["segments"], os.cpu_count() or 1,
+                                    int(clip_duration // SEGMENT_MIN_SECONDS))
+            if segment_count and segment_count > 1:
+                segment_paths = render_segments(
+                    source_path, palette_path, clip["seek"], clip_duration, segment_count,
+                    vf_base, dedupe, fps, f"{job_id}_seg",
+                    tracker("Rendering GIF…", 0.4, 1.0)
+                )
+                stages.start("join")
+                try:
+                    update("Joining segments…", progress=1.0)
+                    concat_gifs(segment_paths, output_path, loop)
+                finally:
+                    for path in segment_paths:
+                        try: os.unlink(path)
+                        except OSError: pass
+                if byproducts:
+                    # The segments each decode only their own span
+                    stages.start("previews")
+                    update("Rendering preview…")
+                    r = run_ffmpeg(["ffmpeg", "-y", *time_args, "-i", source_path, "-filter_complex",
+                                    byproducts[0].replace("[bx]", "[0:v]", 1), *extra_outputs],
+                                   timeout=120, outputs=extra_files)
+                    if r.returncode != 0:
+                        raise RuntimeError(f"Preview rendering failed:\n{r.stderr[-800:]}")
+            else:
+                result = run_ffmpeg(
+                    ["ffmpeg", "-y", *time_args, "-i", source_path, "-i", palette_path,
+                     *filter_args(f"[vin]{vf_gif}[x];[x][1:v]{PALETTEUSE}[vout]"),
+                     *vfr_args, *output_limit_args(), "-loop", str(loop), output_path, *extra_outputs],
+                    timeout=300, outputs=[output_path, *extra_files],
+                    on_progress=tracker("Rendering GIF…", 0.4, 1.0)
+                )
+                if result.returncode != 0:
+                    raise RuntimeError(f"GIF conversion failed:\n{result.stderr[-800:]}")
+
         # ── ffmpeg standard ───────────────────────────────────────────────────
         else:
-            update("Rendering GIF…")
-            result = subprocess.run(
-                ["ffmpeg", "-y", *time_args, "-i", input_path,
-                 "-vf", vf_base, "-loop", str(loop), output_path],
-                capture_output=True, text=True, timeout=300
+            stages.start("render")
+            result = run_ffmpeg(
+                ["ffmpeg", "-y", *time_args, "-i", source_path, *filter_args(f"[vin]{vf_gif}[vout]"),
+                 *vfr_args, *output_limit_args(), "-loop", str(loop), output_path, *extra_outputs],
+                timeout=300, outputs=[output_path, *extra_files],
+                on_progress=tracker("Rendering GIF…", 0.0, 1.0)
             )
             if result.returncode != 0:
                 raise RuntimeError(f"GIF conversion failed:\n{result.stderr[-800:]}")
 
         # ── Gather output info ────────────────────────────────────────────────
         gif_bytes = os.path.getsize(output_path)
-        size_str = f"{gif_bytes/1024:.0f} KB" if gif_bytes < 1024*1024 else f"{gif_bytes/1024/1024:.1f} MB"
-
-        probe = subprocess.run(
-            ["ffprobe", "-v", "quiet", "-select_streams", "v:0",
-             "-count_packets",
-             "-show_entries", "stream=width,height,nb_read_packets",
-             "-of", "csv=p=0", output_path],
-            capture_output=True, text=True
-        )
-        w, h, frames_count = "?", "?", "?"
-        parts_out = probe.stdout.strip().split(",")
-        if len(parts_out) >= 2:
-            w, h = parts_out[0], parts_out[1]
-        if len(parts_out) >= 3 and parts_out[2].strip():
-            frames_count = parts_out[2].strip()
-
-        jobs[job_id] = {
+        size_str = format_size(gif_bytes)
+
+        stages.start("inspect")
+        info = output_info(output_path)
+        stages.stop()
+        check_output(gif_bytes, info)
+
+        result = {
             "status": "done",
             "url": f"/output/{output_name}",
             "filename": output_name,
             "size": size_str,
-            "width": w,
-            "height": h,
-            "frames": frames_count,
+            "width": info["width"],
+            "height": info["height"],
+            "frames": info["frames"],
+            "duration": info["duration"],
             "fps": fps,
             "encoder": encoder,
+            "format": fmt,
+            "palette_mode": palette_mode,
+            "elapsed": round(time.monotonic() - started, 2),
+            "resources": {
+                "cpu_seconds": round(sum(u["cpu_seconds"] for u in usage), 3),
+                "peak_rss_bytes": max((u["peak_rss_bytes"] for u in usage), default=0),
+                "children": usage,
+            },
         }
+        if palette_info:
+            result["palette"] = palette_info
+        for key, path in (("poster", poster_path), ("preview", preview_path)):
+            if path and os.path.exists(path):
+                result[key] = Path(path).name
+                result[f"{key}_url"] = f"/output/{Path(path).name}"
+        if segment_count and segment_count > 1:
+            result["segments"] = segment_count
+        if fit:
+            result["fit"] = {"max_bytes": max_bytes, "colors": fit["colors"],
+                             "dither": fit["dither"], "encodes": fit["attempts"]}
+        output_store.add(result_files(result))
+        result_cache.put(cache_key(video_data["sha256"], opts), result, gif_bytes)
+        set_job(job_id, result, owner)
+        metrics.inc("gifmaker_jobs_total", encoder=encoder, status="done")
+        metrics.observe("gifmaker_job_seconds", time.monotonic() - started, encoder=encoder)
+        metrics.observe("gifmaker_output_bytes", gif_bytes, encoder=encoder, format=fmt)
 
     except Exception as e:
-        jobs[job_id] = {"status": "error", "error": str(e)}
+        set_job(job_id, {"status": "error", "error": str(e)}, owner)
+        stages.stop()
+        for path in (output_path, poster_path, preview_path):
+            if path and os.path.exists(path):
+                try: os.unlink(path)  # partial or over a limit
+                except OSError: pass
+        metrics.inc("gifmaker_jobs_total", encoder=encoder, status="error")
+        metrics.inc("gifmaker_job_errors_total", cause=error_cause(e))
     finally:
         if input_path and os.path.exists(input_path):
             try: os.unlink(input_path)
             except OSError: pass
+        _discard_uploads(params)  # stray file fields spooled by parse_multipart
+        for path in (trimmed_path, work_path):
+            if path and os.path.exists(path):
+                try: os.unlink(path)
+                except OSError: pass
         if palette_path and os.path.exists(palette_path):
             try: os.unlink(palette_path)
             except OSError: pass
-        if frames_dir and os.path.exists(frames_dir):
-            try: shutil.rmtree(frames_dir)
+        if spool:
+            spool.close()
+
+
+def run_batch_conversion(job_id: str, params: dict):
+    """Convert one upload into every variant of a batch with a single decode.
+
+    The decoded clip is split once per variant in one filtergraph; each
+    branch scales and (for ffmpeg-high) builds its own palette in-graph,
+    and is mapped to its own output file.
+    """
+    owner = job_owner.get()
+
+    def update(step, **extra):
+        set_job(job_id, {"status": "running", "step": step, **extra}, owner)
+
+    started = time.monotonic()
+    stages = StageTimer()
+    usage = []
+    job_usage.set(usage)
+    if params.get("queued_at"):
+        metrics.observe("gifmaker_queue_wait_seconds", max(0.0, time.time() - params["queued_at"]))
+    video = params.get("video") if isinstance(params.get("video"), dict) else {}
+    input_path = video.get("path")
+    trimmed_path = None
+    output_paths = []
+    try:
+        if not input_path or not video.get("size"):
+            raise ValueError("No video file received")
+        forms = json.loads(params["variants"])
+        variants = [batch_options(form) for form in forms]
+
+        update("Trimming clip…")
+        media = video.get("media") or probe_media(input_path, video.get("sha256"))
+        stages.start("trim")
+        clip = prepare_clip(input_path, variants[0]["start"], variants[0]["end"], media)
+        trimmed_path = clip["trimmed"]
+        clip_duration = clip["duration"]
+
+        graph = [f"[0:v]split={len(variants)}" + "".join(f"[s{i}]" for i in range(len(variants)))]
+        output_args = []
+        for i, opts in enumerate(variants):
+            scale = "scale=iw:ih" if opts["width"] == "original" else f"scale={opts['width']}:-2:flags=lanczos"
+            vf = f"fps={opts['fps']},{scale}"
+            if opts["dedupe"]:
+                vf += "," + dedupe_filter(opts["fps"], clip_duration, label=f"dd{i}")
+            if opts["encoder"] == "ffmpeg-high":
+                graph.append(f"[s{i}]{vf},split[a{i}][b{i}];[a{i}]palettegen=stats_mode=diff[p{i}];"
+                             f"[b{i}][p{i}]{PALETTEUSE}[o{i}]")
+            else:
+                graph.append(f"[s{i}]{vf}[o{i}]")
+            output_paths.append(str(OUTPUT_DIR / f"{job_id}_{i}.gif"))
+            output_args += ["-map", f"[o{i}]", *(["-fps_mode", "vfr"] if opts["dedupe"] else []),
+                            *output_limit_args(), "-loop", str(opts["loop"]), output_paths[i]]
+
+        step = f"Rendering {len(variants)} GIFs…"
+        update(step, progress=0.0 if clip_duration else None)
+
+        def on_progress(p):
+            progress = eta = None
+            if clip_duration and p["out_time"] is not None:
+                progress = round(min(1.0, p["out_time"] / clip_duration), 3)
+                if progress >= 0.05:
+                    eta = round((time.monotonic() - started) * (1 - progress) / progress)
+            update(step, progress=progress, eta=eta, frame=p["frame"], speed=p["speed"])
+
+        stages.start("render")
+        r = run_ffmpeg(
+            ["ffmpeg", "-y", *clip["time_args"], "-i", clip["path"],
+             "-filter_complex", ";".join(graph), *output_args],
+            timeout=300 * len(variants), outputs=output_paths, on_progress=on_progress
+        )
+        if r.returncode != 0:
+            raise RuntimeError(f"GIF conversion failed:\n{r.stderr[-800:]}")
+
+        stages.start("inspect")
+        outputs = []
+        for opts, path in zip(variants, output_paths):
+            gif_bytes = os.path.getsize(path)
+            info = gif_info(path)
+            check_output(gif_bytes, info)
+            output = {
+                "status": "done",
+                "url": f"/output/{Path(path).name}",
+                "filename": Path(path).name,
+                "size": format_size(gif_bytes),
+                "width": info["width"],
+                "height": info["height"],
+                "frames": info["frames"],
+                "duration": info["duration"],
+                "fps": opts["fps"],
+                "encoder": opts["encoder"],
+                "palette_mode": opts["palette_mode"],
+            }
+            # Keyed by the variant's batch_options, so it serves repeated
+            # batches and only those single requests that ask for the same
+            # normalized options (single-pass palette, previews=0). Default
+            # single requests (two-pass, previews on) key differently.
+            result_cache.put(cache_key(video["sha256"], opts), output, gif_bytes)
+            metrics.observe("gifmaker_output_bytes", gif_bytes, encoder=opts["encoder"], format="gif")
+            outputs.append(output)
+        stages.stop()
+        output_store.add([output["filename"] for output in outputs])
+
+        set_job(job_id, {
+            "status": "done",
+            "outputs": outputs,
+            "elapsed": round(time.monotonic() - started, 2),
+            "resources": {
+                "cpu_seconds": round(sum(u["cpu_seconds"] for u in usage), 3),
+                "peak_rss_bytes": max((u["peak_rss_bytes"] for u in usage), default=0),
+                "children": usage,
+            },
+        }, owner)
+        metrics.inc("gifmaker_jobs_total", encoder="batch", status="done")
+        metrics.observe("gifmaker_job_seconds", time.monotonic() - started, encoder="batch")
+
+    except Exception as e:
+        set_job(job_id, {"status": "error", "error": str(e)}, owner)
+        stages.stop()
+        metrics.inc("gifmaker_jobs_total", encoder="batch", status="error")
+        metrics.inc("gifmaker_job_errors_total", cause=error_cause(e))
+        for path in output_paths:
+            try: os.unlink(path)
+            except OSError: pass
+    finally:
+        if input_path and os.path.exists(input_path):
+            try: os.unlink(input_path)
+            except OSError: pass
+        _discard_uploads(params)
+        if trimmed_path and os.path.exists(trimmed_path):
+            try: os.unlink(trimmed_path)
             except OSError: pass
 
 
@@ -940,27 +4094,446 @@ class GifMakerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     daemon_threads = True
 
 
+class AsyncGifMakerServer:
+    """Single event-loop HTTP/1.1 front end (``--server async``), stdlib only.
+
+    Serves the same routes as Handler without an OS thread per connection:
+    keep-alive, a deadline for request heads, and per-read plus total
+    timeouts on upload bodies keep slow clients from holding resources.
+    Conversions still run on the worker pool.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.listeners = collections.defaultdict(set)  # job id → Events of open /events streams
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        job_listeners.append(self._job_changed)
+        server = await asyncio.start_server(self._handle, self.host or None, self.port,
+                                            reuse_address=True)
+        async with server:
+            await server.serve_forever()
+
+    def _job_changed(self, job_id):
+        # Called from worker threads via notify_job()
+        self.loop.call_soon_threadsafe(self._pulse, job_id)
+
+    def _pulse(self, job_id):
+        if job_id is None:
+            events = [e for group in self.listeners.values() for e in group]
+        else:
+            events = self.listeners.get(job_id, ())
+        for event in events:
+            event.set()
+
+    async def _handle(self, reader, writer):
+        try:
+            timeout = ASYNC_HEADER_TIMEOUT
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError, ConnectionError):
+                    return
+                request_line, _, rest = head.partition(b"\r\n")
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                    headers = http.client.parse_headers(io.BytesIO(rest))
+                except (ValueError, http.client.HTTPException):
+                    await self._send(writer, 400, "text/plain", b"Bad request", keep_alive=False)
+                    return
+
+                connection = headers.get("Connection", "").lower()
+                keep_alive = (connection == "keep-alive" if version == "HTTP/1.0"
+                              else connection != "close")
+                if not await self._dispatch(method, target, headers, reader, writer, keep_alive):
+                    return
+                timeout = ASYNC_KEEPALIVE_TIMEOUT
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _dispatch(self, method, target, headers, reader, writer, keep_alive) -> bool:
+        """Serve one request; returns whether the connection stays open."""
+        path = urllib.parse.urlparse(target).path
+
+        if method == "POST" and target == "/convert":
+            return await self._convert(headers, reader, writer, keep_alive)
+
+        if headers.get("Content-Length", "0") not in ("", "0"):
+            keep_alive = False  # don't try to skip over an unread body
+
+        if method != "GET":
+            await self._send(writer, 404, "text/plain", b"Not found", keep_alive=keep_alive)
+        elif path == "/" or path == "/index.html":
+            await self._send(writer, 200, "text/html", HTML.encode(), keep_alive=keep_alive)
+        elif path == "/favicon.svg":
+            await self._send(writer, 200, "image/svg+xml", FAVICON_SVG.encode(), keep_alive=keep_alive)
+        elif path == "/stats":
+            # Store reads are SQLite queries; keep them off the event loop
+            stats = await self.loop.run_in_executor(None, server_stats)
+            await self._json(writer, 200, stats, keep_alive=keep_alive)
+        elif path == "/metrics":
+            body = (await self.loop.run_in_executor(None, metrics_text)).encode()
+            await self._send(writer, 200, "text/plain; version=0.0.4; charset=utf-8", body,
+                             keep_alive=keep_alive)
+        elif path.startswith("/status/"):
+            job = await self.loop.run_in_executor(None, job_status, path.split("/")[-1])
+            await self._json(writer, 200, job, keep_alive=keep_alive)
+        elif path.startswith("/events/"):
+            await self._stream_events(writer, path.split("/")[-1])
+            return False
+        elif path.startswith("/output/"):
+            fpath = OUTPUT_DIR / path.split("/")[-1]
+            if fpath.exists() and fpath.suffix in OUTPUT_TYPES:
+                # A SQLite write with the job store; keep it off the event loop
+                await self.loop.run_in_executor(None, output_store.touch, fpath.name)
+                await self._send_file(writer, fpath, OUTPUT_TYPES[fpath.suffix], headers, keep_alive)
+            else:
+                await self._send(writer, 404, "text/plain", b"Not found", keep_alive=keep_alive)
+        else:
+            await self._send(writer, 404, "text/plain", b"Not found", keep_alive=keep_alive)
+        return keep_alive
+
+    async def _convert(self, headers, reader, writer, keep_alive) -> bool:
+        try:
+            content_length = int(headers.get("Content-Length", 0))
+            # The disk check may evict outputs; keep it off the event loop
+            rejected = await self.loop.run_in_executor(None, upload_precheck, content_length)
+            if rejected:
+                await self._json(writer, *rejected, keep_alive=False)
+                return False
+            parser = MultipartParser(multipart_boundary(headers.get("Content-Type", "")))
+        except ValueError as e:
+            await self._json(writer, 400, {"error": f"Upload parse error: {e}"}, keep_alive=False)
+            return False
+
+        # Stream the body into the parser; file parts go straight to disk
+        started = time.monotonic()
+        deadline = self.loop.time() + ASYNC_UPLOAD_TIMEOUT
+        remaining = content_length
+        try:
+            while remaining > 0:
+                timeout = min(ASYNC_BODY_READ_TIMEOUT, deadline - self.loop.time())
+                if timeout <= 0:
+                    raise asyncio.TimeoutError
+                chunk = await asyncio.wait_for(
+                    reader.read(min(UPLOAD_CHUNK_BYTES, remaining)), timeout)
+                if not chunk:
+                    raise ValueError("Upload ended early")
+                remaining -= len(chunk)
+                parser.feed(chunk)
+            params = parser.finish()
+        except asyncio.TimeoutError:
+            parser.abort()
+            record_upload(content_length - remaining, started, ok=False)
+            await self._json(writer, 408, {"error": "Upload timed out"}, keep_alive=False)
+            return False
+        except Exception as e:
+            parser.abort()
+            record_upload(content_length - remaining, started, ok=False)
+            await self._json(writer, 400, {"error": f"Upload parse error: {e}"}, keep_alive=False)
+            return False
+        record_upload(content_length, started, ok=True)
+
+        # submit_upload runs ffprobe; keep it off the event loop
+        response = await self.loop.run_in_executor(None, submit_upload, params)
+        await self._json(writer, *response, keep_alive=keep_alive)
+        return keep_alive
+
+    async def _stream_events(self, writer, job_id):
+        """Async twin of Handler._stream_events; waits on its own Event in
+        self.listeners, which _pulse sets for this job only."""
+        writer.write(self._head(200, SSE_HEADERS, keep_alive=False))
+        last = None
+        last_write = self.loop.time()
+        changed = asyncio.Event()
+        self.listeners[job_id].add(changed)
+        try:
+            while True:
+                changed.clear()  # before reading, so no update is missed
+                job = await self.loop.run_in_executor(None, job_status, job_id)
+                if job != last:
+                    writer.write(sse_message(job))
+                    await writer.drain()
+                    last, last_write = job, self.loop.time()
+                    if job.get("status") in ("done", "error", "unknown"):
+                        break
+                    continue
+                if self.loop.time() - last_write >= SSE_KEEPALIVE_SECONDS:
+                    writer.write(SSE_KEEPALIVE)
+                    await writer.drain()
+                    last_write = self.loop.time()
+                try:
+                    await asyncio.wait_for(changed.wait(), sse_wait_seconds())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.listeners[job_id].discard(changed)
+            if not self.listeners[job_id]:
+                del self.listeners[job_id]
+
+    async def _send_file(self, writer, fpath, ctype, headers, keep_alive):
+        try:
+            f = open(fpath, "rb")
+        except OSError:
+            await self._send(writer, 404, "text/plain", b"Not found", keep_alive=keep_alive)
+            return
+        with f:
+            status, response_headers, offset, count = file_response(f, ctype, fpath.name, headers)
+            writer.write(self._head(status, response_headers, keep_alive))
+            await writer.drain()
+            if count:
+                await self.loop.sendfile(writer.transport, f, offset, count)
+
+    async def _send(self, writer, code, ctype, body, headers=None, keep_alive=True):
+        head = {"Content-Type": ctype, "Content-Length": str(len(body)), **(headers or {})}
+        writer.write(self._head(code, head, keep_alive) + body)
+        await writer.drain()
+
+    async def _json(self, writer, code, data, headers=None, keep_alive=True):
+        await self._send(writer, code, "application/json", json.dumps(data).encode(),
+                         headers, keep_alive)
+
+    @staticmethod
+    def _head(code, headers, keep_alive) -> bytes:
+        lines = [
+            f"HTTP/1.1 {code} {http.HTTPStatus(code).phrase}",
+            f"Date: {email.utils.formatdate(usegmt=True)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+            *(f"{k}: {v}" for k, v in headers.items()),
+        ]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
 def _cleanup_loop():
-    """Background thread: delete GIFs and job entries older than 1 hour."""
+    """Background thread: expire outputs unaccessed for OUTPUT_MAX_AGE_SECONDS
+    and prune old job entries. The byte quota is enforced as jobs finish
+    (OutputStore.add); this only handles age and stray files."""
     while True:
         time.sleep(1800)  # run every 30 minutes
-        cutoff = time.time() - 3600
-        for fpath in list(OUTPUT_DIR.iterdir()):
-            if fpath.suffix == ".gif":
-                try:
-                    if fpath.stat().st_mtime < cutoff:
-                        fpath.unlink()
-                except OSError:
-                    pass
-        with jobs_lock:
-            stale = [k for k, v in list(jobs.items())
-                     if isinstance(v, dict) and v.get("status") in ("done", "error")]
-            for k in stale[:-100]:  # keep last 100 completed
-                jobs.pop(k, None)
+        if OUTPUT_MAX_AGE_SECONDS:
+            cutoff = time.time() - OUTPUT_MAX_AGE_SECONDS
+            output_store.expire(cutoff, exempt=result_cache.filenames())
+            # Untracked leftovers (palettes, segments, crashed jobs' partials)
+            tracked = output_store.names()
+            for fpath in list(OUTPUT_DIR.iterdir()):
+                if fpath.suffix in OUTPUT_TYPES and fpath.name not in tracked:
+                    try:
+                        if fpath.stat().st_mtime < cutoff:
+                            fpath.unlink()
+                    except OSError:
+                        pass
+        result_cache.discard_missing()
+        job_store.prune(keep_finished=100)  # keep last 100 completed
+
+
+# ── Benchmark (python app.py benchmark) ───────────────────────────────────────
+
+# (lavfi source, size, seconds); generated once per run with fixed settings
+BENCHMARK_CLIPS = (
+    ("testsrc", "640x360", 5),
+    ("testsrc", "1280x720", 10),
+    ("mandelbrot", "640x360", 5),
+    ("mandelbrot", "1280x720", 10),
+    ("color", "640x360", 5),  # static throughout: dedupe must keep its length
+)
+# Encoder paths, pipeline modes and output formats, as /convert form fields
+BENCHMARK_VARIANTS = {
+    "ffmpeg-high": {"encoder": "ffmpeg-high", "palette_mode": "two-pass"},
+    "ffmpeg-high/single-pass": {"encoder": "ffmpeg-high", "palette_mode": "single-pass"},
+    "ffmpeg-high/sampled": {"encoder": "ffmpeg-high", "palette_mode": "sampled"},
+    "libvips": {"encoder": "libvips"},
+    "ffmpeg-med": {"encoder": "ffmpeg-med"},
+    "ffmpeg-high/dedupe": {"encoder": "ffmpeg-high", "palette_mode": "two-pass", "dedupe": "1"},
+    "ffmpeg/webp": {"encoder": "ffmpeg-med", "format": "webp"},
+    "ffmpeg/apng": {"encoder": "ffmpeg-med", "format": "apng"},
+    "ffmpeg/mp4": {"encoder": "ffmpeg-med", "format": "mp4"},
+    "libvips/webp": {"encoder": "libvips", "format": "webp"},
+}
+
+
+def make_benchmark_clip(source: str, size: str, seconds: int, path: str):
+    """Encode a deterministic synthetic H.264 clip from an ffmpeg lavfi source."""
+    r = subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"{source}=size={size}:rate=30",
+         "-t", str(seconds), "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+         "-g", "60", "-threads", "1", "-bitexact", path],
+        capture_output=True, text=True, timeout=600
+    )
+    if r.returncode != 0:
+        raise RuntimeError(f"Clip generation failed:\n{r.stderr[-800:]}")
+
+
+def output_ssim(output_path: str, source_path: str, fps: int, width: int, height: int):
+    """Mean SSIM of the output's frames against the source resampled the
+    same way (None where ffmpeg can't decode the output, e.g. animated WebP)."""
+    r = subprocess.run(
+        ["ffmpeg", "-v", "info", "-nostats", "-i", output_path, "-i", source_path, "-lavfi",
+         f"[0:v]fps={fps},format=yuv444p[a];"
+         f"[1:v]fps={fps},scale={width}:{height}:flags=lanczos,format=yuv444p[b];"
+         "[a][b]ssim=shortest=1", "-f", "null", "-"],
+        capture_output=True, text=True, timeout=600
+    )
+    m = re.search(r"SSIM .*All:([\d.]+)", r.stderr)
+    return float(m.group(1)) if m else None
+
+
+def _benchmark_case(clip_path: str, form: dict, work_dir: str, seconds: float) -> dict:
+    """Run one conversion in this (fresh) process and measure it.
+
+    Every temp file and the output land in ``work_dir``, which is sampled
+    for its peak size while the job runs. ``seconds`` is the clip's length,
+    which the output's duration is checked against.
+    """
+    global OUTPUT_DIR, SPOOL_DIR
+    import tempfile
+    OUTPUT_DIR = SPOOL_DIR = Path(work_dir)
+    tempfile.tempdir = work_dir
+
+    input_path = os.path.join(work_dir, "input" + Path(clip_path).suffix)
+    shutil.copyfile(clip_path, input_path)
+    input_bytes = os.path.getsize(input_path)
+    peak = [0]
+    running = threading.Event()
+    running.set()
+
+    def sample_disk():
+        while running.is_set():
+            total = 0
+            for entry in os.scandir(work_dir):
+                try: total += entry.stat().st_size
+                except OSError: pass
+            peak[0] = max(peak[0], total)
+            time.sleep(0.05)
+
+    sampler = threading.Thread(target=sample_disk, daemon=True)
+    sampler.start()
+    job_id = "bench"
+    params = {**form, "video": {"filename": Path(clip_path).name, "path": input_path,
+                                "size": input_bytes, "sha256": uuid.uuid4().hex}}
+    wall = time.monotonic()
+    run_conversion(job_id, params)
+    wall = time.monotonic() - wall
+    running.clear()
+    sampler.join()
+
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    rss_unit = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is KiB on Linux
+    record = job_store.get(job_id) or {}
+    case = {
+        "status": record.get("status"),
+        "wall_seconds": round(wall, 3),
+        "cpu_seconds": round(sum(u.ru_utime + u.ru_stime for u in usage), 3),
+        "peak_rss_bytes": max(u.ru_maxrss for u in usage) * rss_unit,
+    }
+    if record.get("status") != "done":
+        case["error"] = record.get("error")
+        return case
+    output_path = os.path.join(work_dir, record["filename"])
+    size = os.path.getsize(output_path)
+    case.update({
+        "size_bytes": size,
+        "format": record.get("format", "gif"),
+        # Peak scratch space beyond the input copy and the finished output
+        "temp_bytes": max(0, peak[0] - input_bytes - size),
+        "frames": record["frames"],
+        # Output length minus clip length; a dropped static tail shows here
+        "duration_error": round(record["duration"] - seconds, 2) or 0.0,
+        "ssim": output_ssim(output_path, clip_path, record["fps"], record["width"], record["height"]),
+    })
+    return case
+
+
+def run_benchmark(variants: list, clips: list, fps: int, width: str) -> dict:
+    """Benchmark each variant on each synthetic clip; one process per case."""
+    import tempfile
+    os.environ["JOB_STORE"] = "memory"  # keep benchmark jobs out of jobs.db
+    version = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True)
+    report = {
+        "ffmpeg": (version.stdout.splitlines() or ["?"])[0],
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "fps": fps,
+        "width": width,
+        "cases": [],
+    }
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(prefix="gif-bench-") as root:
+        for source, size, seconds in clips:
+            clip_name = f"{source}-{size}-{seconds}s"
+            clip_path = os.path.join(root, clip_name + ".mp4")
+            make_benchmark_clip(source, size, seconds, clip_path)
+            for variant in variants:
+                print(f"  {clip_name} · {variant}", file=sys.stderr)
+                work_dir = tempfile.mkdtemp(dir=root)
+                form = {"fps": str(fps), "width": width, "previews": "0", **BENCHMARK_VARIANTS[variant]}
+                with concurrent.futures.ProcessPoolExecutor(1, mp_context=ctx) as pool:
+                    case = pool.submit(_benchmark_case, clip_path, form, work_dir, seconds).result()
+                shutil.rmtree(work_dir, ignore_errors=True)
+                report["cases"].append({"clip": clip_name, "variant": variant, **case})
+    return report
+
+
+def _parse_benchmark_clip(value: str) -> tuple:
+    try:
+        source, size, seconds = value.split(":")
+        return source, size, int(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected SOURCE:WxH:SECONDS, e.g. testsrc:640x360:5")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="GIF Maker — MP4 → GIF converter")
+    parser.add_argument("--server", choices=("threaded", "async"),
+                        default=os.environ.get("SERVER_MODE", "threaded"),
+                        help="HTTP front end: thread per connection, or one asyncio event loop")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WORKERS", 0)),
+                        metavar="N",
+                        help="run conversions in N worker processes instead of threads "
+                             "in the HTTP process (needs JOB_STORE=sqlite)")
+    commands = parser.add_subparsers(dest="command")
+    bench = commands.add_parser("benchmark", help="time the encoders on synthetic clips, print JSON")
+    bench.add_argument("--variant", action="append", choices=list(BENCHMARK_VARIANTS),
+                       help="encoder path or output format to run (repeatable; default: all)")
+    bench.add_argument("--clip", action="append", type=_parse_benchmark_clip,
+                       metavar="SOURCE:WxH:SECONDS",
+                       help="lavfi test source to generate (repeatable; default: built-in set)")
+    bench.add_argument("--fps", type=int, default=15)
+    bench.add_argument("--width", default="640")
+    bench.add_argument("--output", metavar="FILE", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        report = run_benchmark(args.variant or list(BENCHMARK_VARIANTS),
+                               args.clip or list(BENCHMARK_CLIPS), args.fps, args.width)
+        text = json.dumps(report, indent=2)
+        if args.output:
+            Path(args.output).write_text(text + "\n")
+        else:
+            print(text)
+        return
+
+    if args.workers and not job_store.shared:
+        parser.error("--workers needs JOB_STORE=sqlite")
+
+    output_store.sync()  # pick up outputs left by the previous run
     threading.Thread(target=_cleanup_loop, daemon=True).start()
+    if args.workers:
+        start_worker_processes(args.workers)
+    else:
+        start_workers()
 
     print(f"\n  GIF Maker running at http://0.0.0.0:{PORT}")
     is_local = sys.stdout.isatty()
@@ -970,11 +4543,17 @@ def main():
         threading.Timer(0.8, lambda: webbrowser.open(f"http://localhost:{PORT}")).start()
 
     try:
-        with GifMakerServer(("", PORT), Handler) as httpd:
+        if args.server == "async":
             try:
-                httpd.serve_forever()
+                AsyncGifMakerServer("", PORT).serve_forever()
             except KeyboardInterrupt:
                 print("\n  Stopped.")
+        else:
+            with GifMakerServer(("", PORT), Handler) as httpd:
+                try:
+                    httpd.serve_forever()
+                except KeyboardInterrupt:
+                    print("\n  Stopped.")
     except OSError as e:
         if "Address already in use" in str(e):
             print(f"\n  Port {PORT} is already in use.")